@@ -770,7 +770,9 @@ class gui_frame(wx.Frame):
 					     dir, longname, "psu",
 					     "EMS save file (.psu)|*.psu"
 					     "|MAXDrive save file (.max)"
-					     "|*.max",
+					     "|*.max"
+					     "|Codebreaker save file (.cbs)"
+					     "|*.cbs",
 					     (wx.FD_OVERWRITE_PROMPT
 					      | wx.FD_SAVE),
 					     self)
@@ -781,6 +783,8 @@ class gui_frame(wx.Frame):
 				try:
 					if fn.endswith(".max"):
 						sf.save_max_drive(f)
+					elif fn.endswith(".cbs"):
+						sf.save_codebreaker(f)
 					else:
 						sf.save_ems(f)
 				finally:
@@ -863,12 +867,13 @@ class gui_frame(wx.Frame):
 			return
 
 		success = None
-		for fn in fd.GetPaths():
-			try:
-				self._do_import(fn)
-				success = fn
-			except EnvironmentError as value:
-				self.mc_error(value, fn)
+		with self.mc.transaction():
+			for fn in fd.GetPaths():
+				try:
+					self._do_import(fn)
+					success = fn
+				except EnvironmentError as value:
+					self.mc_error(value, fn)
 
 		if success != None:
 			dir = os.path.dirname(success)
@@ -900,13 +905,15 @@ class gui_frame(wx.Frame):
 		if r != wx.YES:
 			return
 
-		for dn in dirnames:
-			try:
-				mc.rmdir("/" + dn)
-			except EnvironmentError as value:
-				self.mc_error(value, dn)
+		with mc.transaction():
+			for dn in dirnames:
+				try:
+					mc.rmdir("/" + dn)
+				except EnvironmentError as value:
+					self.mc_error(value, dn)
 
-		mc.check()
+		for line in mc.check().lines():
+			print(line)
 		self.refresh()
 
 	def evt_cmd_ascii(self, event):
@@ -6,9 +6,9 @@
 
 """
 Implementation of Haruhiko Okumura's LZARI data compression algorithm
-in Python.  Largely based on LZARI.C, one key difference is the use of
-a two level dicitionary look up during compression rather than
-LZARI.C's binary search tree.
+in Python.  Largely based on LZARI.C, one key difference is that
+matches are found during compression by searching the history with
+bytes.rfind() rather than with LZARI.C's binary search tree.
 """
 
 _SCCS_ID = "@(#) mymc lzari.py 1.6 12/10/04 19:07:53\n"
@@ -17,8 +17,7 @@ import sys
 import array
 import binascii
 import time
-from bisect import bisect_right
-from math import log
+from bisect import bisect_left
 
 try:
 	import ctypes
@@ -28,7 +27,8 @@ except ImportError:
 
 hexlify = binascii.hexlify
 
-__ALL__ = ['lzari_codec', 'string_to_bit_array', 'bit_array_to_string']
+__ALL__ = ['lzari_codec', 'lzari_reader', 'string_to_bit_array',
+	   'bit_array_to_string']
 
 #
 # Fundamental constants of the LZARI compression alogorithm.
@@ -53,6 +53,7 @@ MAX_CHAR = (256 + MAX_MATCH_LEN - MIN_MATCH_LEN + 1)
 #
 
 MAX_SUFFIX_CHAIN = 50	# limit on how many identical suffixes to try to match
+DECODE_CHUNK_SIZE = 65536	# size of the chunks decode_chunks() generates
 
 #def debug(value, msg):
 #	print "@@@ %s %04x" % (msg, value)
@@ -95,30 +96,16 @@ def bit_array_to_string(a):
 	s = binascii.unhexlify(s.translate(_tr_rev_4))
 	return binascii.unhexlify(s.translate(_tr_rev_16))
 
-def _match(src, pos, hpos, mlen, end):
-	mlen += 1
-	if not src.startswith(src[hpos : hpos + mlen], pos):
-		return None
-	for i in range(mlen, end):
-		if src[pos + i] != src[hpos + i]:
-			return i
-	return end
-
-def _rehash_table2(src, chars, head, next, next2, hist_invalid):
-	p = head
-	table2 = {}
-	l = []
-	while p > hist_invalid:
-		l.append(p)
-		p = next[p % HIST_LEN]
-	l.reverse()
-	for p in l:
-		p2 = p + MIN_MATCH_LEN
-		key2 = src[p2 : p2 + chars]
-		head2 = table2.get(key2, hist_invalid)
-		next2[p % HIST_LEN] = head2
-		table2[key2] = p
-	return table2
+def _sum_tree(freq):
+	"""Build a binary indexed tree of the sums of freq[1:]."""
+
+	tree = list(freq)
+	n = len(tree)
+	for i in range(1, n):
+		j = i + (i & -i)
+		if j < n:
+			tree[j] += tree[i]
+	return tree
 
 class lzari_codec:
 	# despite the name this does not implement a codec compatible
@@ -129,79 +116,36 @@ class lzari_codec:
 		self.low = 0
 		if decode:
 			self.code = 0
-			# reverse the order of sym_cum so bisect_right() can
-			# be used for faster searching
-			self.sym_cum = list(range(0, MAX_CHAR + 1))
 		else:
 			self.shifts = 0
-			self.char_to_symbol = list(range(1, MAX_CHAR + 1))
-			self.sym_cum = list(range(MAX_CHAR, -1, -1))
-			self.next_table = [None] * HIST_LEN
-			self.next2_table = [None] * HIST_LEN
-			self.suffix_table = {}
 
+		self.char_to_symbol = list(range(1, MAX_CHAR + 1))
 		self.symbol_to_char = [0] + list(range(MAX_CHAR))
 		self.sym_freq = [0] + [1] * MAX_CHAR
+		self.sym_total = MAX_CHAR
+		self.sym_tree = _sum_tree(self.sym_freq)
 		self.position_cum = [0] * (HIST_LEN + 1)
 		a = 0
 		for i in range(HIST_LEN, 0, -1):
 			a = a + 10000 // (200 + i)
 			self.position_cum[i - 1] = a
+		if decode:
+			# negated so bisect() can be used for searching
+			self.position_neg_cum = [-a for a in self.position_cum]
 
-	def search(self, table, x):
-		c = 1
-		s = len(table) - 1
-		while True:
-			a = (s + c) // 2
-			if table[a] <= x:
-				s = a
-			else:
-				c = a + 1
-			if c >= s:
-				break
-		return c
-
-	def update_model_decode(self, symbol):
-		# A compatible implemention to the one used while compressing.
+	def update_model(self, symbol):
+		# Rather than a table of cumulative frequencies that takes
+		# time proportional to the symbol number to update, the
+		# frequencies are summed with a binary indexed tree.
 
 		sym_freq = self.sym_freq
-		sym_cum = self.sym_cum
-
-		if self.sym_cum[MAX_CHAR] >= MAX_CUM:
-			c = 0
-			for i in range(MAX_CHAR, 0, -1):
-				self.sym_cum[MAX_CHAR - i] = c
-				a = (self.sym_freq[i] + 1) // 2
-				self.sym_freq[i] = a
-				c += a
-			self.sym_cum[MAX_CHAR] = c
-		freq = sym_freq[symbol]
-		new_symbol = symbol
-		while self.sym_freq[new_symbol - 1] == freq:
-			new_symbol -= 1
-		# new_symbol = sym_freq.index(freq)
-		if new_symbol != symbol:
-			symbol_to_char = self.symbol_to_char
-			swap_char = symbol_to_char[new_symbol]
-			char = symbol_to_char[symbol]
-			symbol_to_char[new_symbol] = char
-			symbol_to_char[symbol] = swap_char
-		sym_freq[new_symbol] = freq + 1
-		for i in range(MAX_CHAR - new_symbol + 1, MAX_CHAR + 1):
-			sym_cum[i] += 1
+		sym_tree = self.sym_tree
 
-	def update_model_encode(self, symbol):
-		sym_freq = self.sym_freq
-		sym_cum = self.sym_cum
-
-		if sym_cum[0] >= MAX_CUM:
-			c = 0
-			for i in range(MAX_CHAR, 0, -1):
-				sym_cum[i] = c
-				a = (sym_freq[i] + 1) // 2
-				sym_freq[i] = a
-				c += a
-			sym_cum[0] = c
+		if self.sym_total >= MAX_CUM:
+			for i in range(1, MAX_CHAR + 1):
+				sym_freq[i] = (sym_freq[i] + 1) // 2
+			self.sym_total = sum(sym_freq)
+			self.sym_tree = sym_tree = _sum_tree(sym_freq)
 		freq = sym_freq[symbol]
 		new_symbol = symbol
 		while sym_freq[new_symbol - 1] == freq:
@@ -215,73 +159,10 @@ class lzari_codec:
 			self.char_to_symbol[char] = new_symbol
 			self.char_to_symbol[swap_char] = symbol
 		sym_freq[new_symbol] += 1
-		for i in range(new_symbol):
-			sym_cum[i] += 1
-
-	def decode_char(self):
-		high = self.high
-		low = self.low
-		code = self.code
-		sym_cum = self.sym_cum
-
-		_range = high - low
-		max_cum_freq = sym_cum[MAX_CHAR]
-		n = ((code - low + 1) * max_cum_freq - 1) // _range
-		i = bisect_right(sym_cum, n, 1)
-		high = low + sym_cum[i] * _range // max_cum_freq
-		low += sym_cum[i - 1] * _range // max_cum_freq
-		symbol = MAX_CHAR + 1 - i
-
-		while True:
-			if low < QUADRANT2:
-				if low < QUADRANT1 or high > QUADRANT3:
-					if high > QUADRANT2:
-						break
-				else:
-					low -= QUADRANT1
-					code -= QUADRANT1
-					high -= QUADRANT1
-			else:
-				low -= QUADRANT2
-				code -= QUADRANT2
-				high -= QUADRANT2
-			low *= 2
-			high *= 2
-			code = code * 2 + self.in_iter()
-
-		ret = self.symbol_to_char[symbol]
-		self.high = high
-		self.low = low
-		self.code = code
-		self.update_model_decode(symbol)
-		return ret
-
-	def decode_position(self):
-		_range = self.high - self.low
-		max_cum = self.position_cum[0]
-		pos = self.search(self.position_cum,
-				  ((self.code - self.low + 1)
-				   * max_cum - 1) // _range) - 1
-		self.high = (self.low +
-			     self.position_cum[pos] * _range // max_cum)
-		self.low += self.position_cum[pos + 1] * _range // max_cum
-		while True:
-			if self.low < QUADRANT2:
-				if (self.low < QUADRANT1
-				    or self.high > QUADRANT3):
-					if self.high > QUADRANT2:
-						return pos
-				else:
-					self.low -= QUADRANT1
-					self.code -= QUADRANT1
-					self.high -= QUADRANT1
-			else:
-				self.low -= QUADRANT2
-				self.code -= QUADRANT2
-				self.high -= QUADRANT2
-			self.low *= 2
-			self.high *= 2
-			self.code = self.in_iter() + self.code * 2
+		self.sym_total += 1
+		while new_symbol <= MAX_CHAR:
+			sym_tree[new_symbol] += 1
+			new_symbol += new_symbol & -new_symbol
 
 	def add_suffix_1(self, pos, find):
 		# naive implemention used for testing
@@ -300,140 +181,39 @@ class lzari_codec:
 			mlen -= 1
 		return (None, -1)
 
-	def add_suffix_2(self, pos, find):
-		# a two level dictionary look up that leverages Python's
-		# built-in dicts to get something that's hopefully faster
-		# than implementing binary trees in completely in Python.
+	def add_suffix_3(self, pos, find):
+		# Finds the same match as add_suffix_1(), the most recent
+		# of the longest matches, but searches for longer matches
+		# only once a shorter one has been found and extended as
+		# far as it goes.  Nothing needs to be done for positions
+		# that aren't searched.
 
+		if not find:
+			return (None, 0)
 		src = self.src
-		suffix_table = self.suffix_table
 		max_match = min(self.max_match, len(src) - pos)
-
-		mlen = -1
-		mpos = None
-
-		hist_invalid = pos - HIST_LEN - 1
-		modpos = pos % HIST_LEN
-		pos2 = pos + MIN_MATCH_LEN
-
-		key = src[pos : pos2]
-		a = suffix_table.get(key)
-		if a != None:
-			next = self.next_table
-			next2 = self.next2_table
-
-			[count, head, table2, chars] = a
-
-			pos3 = pos2 + chars
-			key2 = src[pos2 : pos3]
-			min_match2 = MIN_MATCH_LEN + chars
-			if find:
-				p = table2.get(key2, hist_invalid)
-				maxmlen = max_match - min_match2
-				while p > hist_invalid and mlen != maxmlen:
-					p3 = p + min_match2
-					if mpos == None and p3 <= pos:
-						mpos = p
-						mlen = 0
-					if p3 >= pos:
-						p = next2[p % HIST_LEN]
-						continue
-					rlen = _match(src, pos3, p3, mlen,
-						      min(maxmlen, pos - p3))
-					if rlen != None:
-						mpos = p
-						mlen = rlen
-					p = next2[p % HIST_LEN]
-			if mpos != None:
-				mlen += min_match2
-			elif find:
-				p = head
-				maxmlen = min(chars, max_match - MIN_MATCH_LEN)
-				i = 0
-				while (p > hist_invalid and i < 50000
-				       and mlen < maxmlen):
-					assert i < count
-					i += 1
-					p2 = p + MIN_MATCH_LEN
-					l2 = pos - p2
-					if mpos == None and l2 >= 0:
-						mpos = p
-						mlen = 0
-					if l2 <= 0:
-						p = next[p % HIST_LEN]
-						continue
-					if l2 > maxmlen:
-						l2 = maxmlen
-					m = mlen + 1
-					if src.startswith(src[p2 : p2 + m],
-							  pos2):
-						mpos = p
-						for j in range(m, l2):
-							if (src[pos2 + j]
-							    != src[p2 + j]):
-								mlen = j
-								break
-						else:
-							mlen = l2
-					#rlen = _match(src, pos2, p2, mlen, l2)
-					#if rlen != None:
-					#	mpos = p
-					#	mlen = rlen
-					p = next[p % HIST_LEN]
-
-				if mpos != None:
-					mlen += MIN_MATCH_LEN
-
-			count += 1
-			new_chars = int(log(count, 2))
-			# new_chars = 50
-			new_chars = min(new_chars, max_match - MIN_MATCH_LEN)
-			if new_chars > chars:
-				chars = new_chars
-				table2 = _rehash_table2(src, chars, head,
-							next, next2,
-							hist_invalid)
-
-			next[modpos] = head
-			head = pos
-
-			key2 = src[pos2 : pos2 + chars]
-			head2 = table2.get(key2, hist_invalid)
-			next2[modpos] = head2
-			table2[key2] = pos
-
-			a[0] = count
-			a[1] = head
-			a[2] = table2
-			a[3] = chars
-		else:
-			self.next_table[modpos] = hist_invalid
-			self.next2_table[modpos] = hist_invalid
-			key2 = b""
-			# key2 = src[pos2 : pos2 + 1]
-			suffix_table[key] = [1, pos, {key2: pos}, len(key2)]
-
-		p = pos - HIST_LEN
-		if p >= 0:
-			p2 = p + MIN_MATCH_LEN
-			key = src[p : p2]
-			a = suffix_table[key]
-			(count, head, table2, chars) = a
-			count -= 1
-			if count == 0:
-				assert head == p
-				del suffix_table[key]
-			else:
-				key2 = src[p2 : p2 + chars]
-				if table2[key2] == p:
-					del table2[key2]
-				a[0] = count
-		assert (mpos == None
-			or src[pos : pos + mlen] == src[mpos : mpos + mlen])
+		hist_start = max(pos - HIST_LEN, 0)
+		mlen = MIN_MATCH_LEN
+		if max_match < mlen:
+			return (None, -1)
+		mpos = src.rfind(src[pos : pos + mlen], hist_start, pos)
+		if mpos == -1:
+			return (None, -1)
+		while True:
+			end = min(max_match, pos - mpos)
+			while mlen < end and src[mpos + mlen] == src[pos + mlen]:
+				mlen += 1
+			if mlen == max_match:
+				break
+			p = src.rfind(src[pos : pos + mlen + 1], hist_start, pos)
+			if p == -1:
+				break
+			mpos = p
+			mlen += 1
 		return (mpos, mlen)
 
 	def _add_suffix(self, pos, find):
-		r = self.add_suffix_2(pos, find)
+		r = self.add_suffix_3(pos, find)
 		start_pos = self.start_pos
 		if find and r[0] != None:
 			print(("%4d %02x %4d %2d"
@@ -444,7 +224,7 @@ class lzari_codec:
 				       % (pos - start_pos, self.src[pos])))
 		return r
 
-	add_suffix = add_suffix_2
+	add_suffix = add_suffix_3
 
 	def output_bit(self, bit):
 		self.append_bit(bit)
@@ -453,67 +233,6 @@ class lzari_codec:
 			self.append_bit(bit)
 		self.shifts = 0
 
-	def encode_char(self, char):
-		low = self.low
-		high = self.high
-		sym_cum = self.sym_cum
-
-		symbol = self.char_to_symbol[char]
-		range = high - low
-
-		high = low + range * sym_cum[symbol - 1] // sym_cum[0]
-		low += range * sym_cum[symbol] // sym_cum[0]
-		debug(high, "high")
-		debug(low, "low")
-		while True:
-			if high <= QUADRANT2:
-				self.output_bit(0)
-			elif low >= QUADRANT2:
-				self.output_bit(1)
-				low -= QUADRANT2
-				high -= QUADRANT2
-			elif low >= QUADRANT1 and high <= QUADRANT3:
-				self.shifts += 1
-				low -= QUADRANT1
-				high -= QUADRANT1
-			else:
-				break
-			low *= 2
-			high *= 2
-		self.low = low
-		self.high = high
-		self.update_model_encode(symbol)
-
-	def encode_position(self, position):
-		position_cum = self.position_cum
-		low = self.low
-		high = self.high
-
-		range = high - low
-		high = low + range * position_cum[position] // position_cum[0]
-		low += range * position_cum[position + 1] // position_cum[0]
-
-		debug(high, "high")
-		debug(low, "low")
-		while True:
-			if high <= QUADRANT2:
-				self.output_bit(0)
-			elif low >= QUADRANT2:
-				self.output_bit(1)
-				low -= QUADRANT2
-				high -= QUADRANT2
-			elif low >= QUADRANT1 and high <= QUADRANT3:
-				self.shifts += 1
-				low -= QUADRANT1
-				high -= QUADRANT1
-			else:
-				break
-			low *= 2
-			high *= 2
-
-		self.low = low
-		self.high = high
-
 	def encode(self, src, progress = None):
 		"""Compress a string."""
 
@@ -523,7 +242,7 @@ class lzari_codec:
 
 		out_array = array.array('B')
 		self.out_array = out_array
-		self.append_bit = out_array.append
+		self.append_bit = append_bit = out_array.append
 
 		self.init(False)
 
@@ -535,9 +254,19 @@ class lzari_codec:
 
 		self.start_pos = max_match
 
-		for in_pos in range(max_match):
-			self.add_suffix(in_pos, False)
-		in_pos += 1
+		# The arithmetic coding of EncodeChar() and EncodePosition()
+		# is done inline with the coder's state kept in local
+		# variables, this loop being where nearly all the time
+		# is spent.
+		add_suffix = self.add_suffix
+		update_model = self.update_model
+		char_to_symbol = self.char_to_symbol
+		sym_freq = self.sym_freq
+		position_cum = self.position_cum
+		low = 0
+		high = QUADRANT4
+		shifts = 0
+		in_pos = max_match
 		last_percent = -1
 		while in_pos < in_length:
 			if progress:
@@ -546,31 +275,88 @@ class lzari_codec:
 					sys.stderr.write("%s%3d%%\r"
 							 % (progress, percent))
 					last_percent = percent
-			debug(src[in_pos], "src")
-			(match_pos, match_len) = self.add_suffix(in_pos, True)
+			(match_pos, match_len) = add_suffix(in_pos, True)
 			if match_len < MIN_MATCH_LEN:
-				self.encode_char(src[in_pos])
+				char = src[in_pos]
 			else:
-				debug(in_pos - match_pos - 1, "match_pos")
-				debug(match_len, "match_len")
-				self.encode_char(256 - MIN_MATCH_LEN
-						 + match_len)
-				self.encode_position(in_pos - match_pos - 1)
-				for i in range(match_len - 1):
-					in_pos += 1
-					self.add_suffix(in_pos, False)
-			in_pos += 1
-
-		self.shifts += 1
-		if self.low < QUADRANT1:
+				char = 256 - MIN_MATCH_LEN + match_len
+			symbol = char_to_symbol[char]
+
+			# the total frequency of the symbols after symbol - 1
+			sym_tree = self.sym_tree
+			total = self.sym_total
+			cum = total
+			i = symbol - 1
+			while i:
+				cum -= sym_tree[i]
+				i &= i - 1
+
+			_range = high - low
+			high = low + _range * cum // total
+			low += _range * (cum - sym_freq[symbol]) // total
+			while True:
+				if high <= QUADRANT2:
+					bit = 0
+				elif low >= QUADRANT2:
+					bit = 1
+					low -= QUADRANT2
+					high -= QUADRANT2
+				elif low >= QUADRANT1 and high <= QUADRANT3:
+					shifts += 1
+					low = (low - QUADRANT1) * 2
+					high = (high - QUADRANT1) * 2
+					continue
+				else:
+					break
+				append_bit(bit)
+				if shifts:
+					out_array.extend((bit ^ 1,) * shifts)
+					shifts = 0
+				low *= 2
+				high *= 2
+			update_model(symbol)
+
+			if match_len < MIN_MATCH_LEN:
+				in_pos += 1
+				continue
+
+			position = in_pos - match_pos - 1
+			debug(position, "match_pos")
+			debug(match_len, "match_len")
+			_range = high - low
+			high = (low + _range * position_cum[position]
+				// position_cum[0])
+			low += _range * position_cum[position + 1] // position_cum[0]
+			while True:
+				if high <= QUADRANT2:
+					bit = 0
+				elif low >= QUADRANT2:
+					bit = 1
+					low -= QUADRANT2
+					high -= QUADRANT2
+				elif low >= QUADRANT1 and high <= QUADRANT3:
+					shifts += 1
+					low = (low - QUADRANT1) * 2
+					high = (high - QUADRANT1) * 2
+					continue
+				else:
+					break
+				append_bit(bit)
+				if shifts:
+					out_array.extend((bit ^ 1,) * shifts)
+					shifts = 0
+				low *= 2
+				high *= 2
+			in_pos += match_len
+
+		self.low = low
+		self.high = high
+		self.shifts = shifts + 1
+		if low < QUADRANT1:
 			self.output_bit(0)
 		else:
 			self.output_bit(1)
 
-		#for k, v in sorted(self.suffix_table.items()):
-		#	count, head, table2, chars = v
-		#	print hexlify(k), count, head, len(table2), chars
-
 		if progress:
 			sys.stderr.write("%s100%%\n" % progress)
 
@@ -579,28 +365,51 @@ class lzari_codec:
 	def decode(self, src, out_length, progress = None):
 		"""Decompress a string."""
 
-		a = string_to_bit_array(src)
-		a.fromlist([0] * 32)	 # add some extra bits
-		self.in_iter = iter(a).__next__
+		return b"".join(self.decode_chunks(src, out_length, progress))
 
-		out = array.array('B', b"\0") * out_length
-		outpos = 0
+	def decode_chunks(self, src, out_length, progress = None,
+			  chunk_size = DECODE_CHUNK_SIZE):
+		"""Decompress a string, generating the output in chunks.
 
-		self.init(True)
+		Only the last HIST_LEN bytes of output are kept between
+		chunks."""
 
-		self.code = 0
-		for i in range(ARITH_BITS + 2):
-			self.code += self.code + self.in_iter()
+		# Bits are taken directly from the compressed bytes, as
+		# many at a time as DecodeChar() and DecodePosition()
+		# would shift in one by one.  The extra zero bytes are
+		# for reading past the end of the input.
+		src = bytes(src) + b"\0" * 8
+		bit_pos = ARITH_BITS + 2
+		code = int.from_bytes(src[0:4], "big") >> (32 - bit_pos)
 
-		hist_pos = HIST_LEN - MAX_MATCH_LEN
-		history = [0x20] * hist_pos + [0] * MAX_MATCH_LEN
+		self.init(True)
+		update_model = self.update_model
+		symbol_to_char = self.symbol_to_char
+		sym_freq = self.sym_freq
+		position_cum = self.position_cum
+		position_neg_cum = self.position_neg_cum
+		max_pos_cum = position_cum[0]
+		top_step = 1 << (MAX_CHAR.bit_length() - 1)
+		low = 0
+		high = QUADRANT4
+
+		# The output is preceded by the initial contents of the
+		# history, so matches can be copied from the output.
+		out = bytearray(b"\0" * MAX_MATCH_LEN
+				+ b"\x20" * (HIST_LEN - MAX_MATCH_LEN))
+		out_end = HIST_LEN + out_length
+		chunk_end = HIST_LEN + chunk_size
 
-		decode_char = self.decode_char
 		last_percent = -1
 		last_time = time.time()
-		while outpos < out_length:
+		while len(out) < out_end:
+			if len(out) >= chunk_end:
+				yield bytes(out[HIST_LEN:])
+				out_end -= len(out) - HIST_LEN
+				del out[: -HIST_LEN]
 			if progress:
-				percent = outpos * 100 // out_length
+				percent = ((out_length - out_end + len(out))
+					   * 100 // out_length)
 				if percent != last_percent:
 					now = time.time()
 					if now - last_time >= 1:
@@ -608,27 +417,133 @@ class lzari_codec:
 							% (progress, percent))
 						last_percent = percent
 						last_time = now
-			char = decode_char()
-			if char >= 0x100:
-				pos = self.decode_position()
-				length = char - 0x100 + MIN_MATCH_LEN
-				base = (hist_pos - pos - 1) % HIST_LEN
-				for off in range(length):
-					a = history[(base + off) % HIST_LEN]
-					out[outpos] = a
-					outpos += 1
-					history[hist_pos] = a
-					hist_pos = (hist_pos + 1) % HIST_LEN
+
+			# find the symbol whose cumulative frequencies
+			# bracket the code by descending the sum tree
+			sym_tree = self.sym_tree
+			total = self.sym_total
+			_range = high - low
+			target = total - ((code - low + 1) * total - 1) // _range
+			if target < 1:
+				raise ValueError("compressed input is corrupt")
+			rem = target
+			symbol = 0
+			step = top_step
+			while step:
+				i = symbol + step
+				if i <= MAX_CHAR and sym_tree[i] < rem:
+					symbol = i
+					rem -= sym_tree[i]
+				step >>= 1
+			symbol += 1
+			if symbol > MAX_CHAR:
+				raise ValueError("compressed input is corrupt")
+			# the total frequency of the symbols after symbol - 1
+			cum = total - (target - rem)
+			high = low + cum * _range // total
+			low += (cum - sym_freq[symbol]) * _range // total
+			shift = 0
+			while True:
+				if low < QUADRANT2:
+					if low < QUADRANT1 or high > QUADRANT3:
+						if high > QUADRANT2:
+							break
+					else:
+						low -= QUADRANT1
+						code -= QUADRANT1
+						high -= QUADRANT1
+				else:
+					low -= QUADRANT2
+					code -= QUADRANT2
+					high -= QUADRANT2
+				low *= 2
+				high *= 2
+				code *= 2
+				shift += 1
+			if shift:
+				i = bit_pos >> 3
+				n = ((bit_pos & 7) + shift + 7) >> 3
+				code += ((int.from_bytes(src[i : i + n], "big")
+					  >> (n * 8 - (bit_pos & 7) - shift))
+					 & ((1 << shift) - 1))
+				bit_pos += shift
+
+			char = symbol_to_char[symbol]
+			update_model(symbol)
+			if char < 0x100:
+				out.append(char)
+				continue
+
+			_range = high - low
+			pos = bisect_left(position_neg_cum,
+					  -(((code - low + 1) * max_pos_cum - 1)
+					    // _range), 1) - 1
+			high = low + position_cum[pos] * _range // max_pos_cum
+			low += position_cum[pos + 1] * _range // max_pos_cum
+			shift = 0
+			while True:
+				if low < QUADRANT2:
+					if low < QUADRANT1 or high > QUADRANT3:
+						if high > QUADRANT2:
+							break
+					else:
+						low -= QUADRANT1
+						code -= QUADRANT1
+						high -= QUADRANT1
+				else:
+					low -= QUADRANT2
+					code -= QUADRANT2
+					high -= QUADRANT2
+				low *= 2
+				high *= 2
+				code *= 2
+				shift += 1
+			if shift:
+				i = bit_pos >> 3
+				n = ((bit_pos & 7) + shift + 7) >> 3
+				code += ((int.from_bytes(src[i : i + n], "big")
+					  >> (n * 8 - (bit_pos & 7) - shift))
+					 & ((1 << shift) - 1))
+				bit_pos += shift
+
+			length = char - 0x100 + MIN_MATCH_LEN
+			base = len(out) - pos - 1
+			if pos + 1 >= length:
+				out += out[base : base + length]
 			else:
-				out[outpos] = char
-				outpos += 1
-				history[hist_pos] = char
-				hist_pos = (hist_pos + 1) % HIST_LEN
+				# the match overlaps the output being copied
+				out += (out[base:] * (length // (pos + 1) + 1)
+					)[:length]
 
-		self.in_iter = None
 		if progress:
 			sys.stderr.write("%s100%%\n" % progress)
-		return out.tobytes()
+		if out_end > HIST_LEN:
+			yield bytes(out[HIST_LEN : out_end])
+
+class lzari_reader:
+	"""A file-like object that decompresses its input as it's read."""
+
+	def __init__(self, src, out_length, progress = None):
+		if mymcsup == None:
+			self._chunks = lzari_codec().decode_chunks(src,
+								   out_length,
+								   progress)
+		else:
+			self._chunks = iter([decode(src, out_length, progress)])
+		self._buf = bytearray()
+
+	def read(self, size = -1):
+		buf = self._buf
+		while size < 0 or len(buf) < size:
+			chunk = next(self._chunks, None)
+			if chunk == None:
+				break
+			buf += chunk
+		if size < 0:
+			size = len(buf)
+		ret = bytes(buf[:size])
+		del buf[:size]
+		return ret
 
 if mymcsup == None:
 	def decode(src, out_length, progress = None):
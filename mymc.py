@@ -14,7 +14,9 @@ import sys
 import os
 import time
 import textwrap
+import shlex
 from errno import EEXIST, EIO
+from concurrent.futures import ProcessPoolExecutor
 
 #import gc
 #gc.set_debug(gc.DEBUG_LEAK)
@@ -82,11 +84,13 @@ def glob_args(args, globfn):
 def _copy(fout, fin):
 	"""copy the contents of one file to another"""
 
+	buf = bytearray(65536)
+	view = memoryview(buf)
 	while True:
-		s = fin.read(1024)
-		if s == b"":
+		n = fin.readinto(buf)
+		if not n:
 			break
-		fout.write(s)
+		fout.write(view[:n])
 
 
 def do_ls(args, mc, parser):
@@ -147,7 +151,7 @@ def do_extract(args, mc, parser):
 		dont_close_out = True
 		out = open(args.output, "wb")
 	elif args.use_stdout:
-		out = sys.stdout
+		out = getattr(sys.stdout, "buffer", sys.stdout)
 
 	filenames = [a.encode() for a in args.filename]
 	try:
@@ -177,47 +181,133 @@ def do_remove(args, mc, parser):
 	for filename in args.filename:
 		mc.remove(filename.encode())
 
+def _load_save_file(filename, progress = True):
+	"""Load a save file into a ps2_save_file object.
+
+	EMS saves are imported as they're read, so None is returned
+	for them instead."""
+
+	sf = ps2save.ps2_save_file()
+	f = open(filename, "rb")
+	try:
+		ftype = ps2save.detect_file_type(f)
+		f.seek(0)
+		if ftype == "psu":
+			return None
+		if ftype == "max":
+			sf.load_max_drive(f, progress = progress)
+		elif ftype == "cbs":
+			sf.load_codebreaker(f)
+		elif ftype == "sps":
+			sf.load_sharkport(f)
+		elif ftype == "npo":
+			raise io_error(EIO, "nPort saves"
+				       " are not supported.",
+				       filename)
+		else:
+			raise io_error(EIO, "Save file format not"
+				       " recognized", filename)
+	finally:
+		f.close()
+	return sf
+
+def _is_ems_save_file(filename):
+	"""Return True if filename looks like an EMS (.psu) save.
+
+	Errors are ignored, they're reported when the save is loaded."""
+
+	try:
+		f = open(filename, "rb")
+		try:
+			return ps2save.detect_file_type(f) == "psu"
+		finally:
+			f.close()
+	except EnvironmentError:
+		return False
+
+def _decode_save_file(filename):
+	"""Load and completely decode a save file in a worker process."""
+
+	sf = _load_save_file(filename, False)
+	if sf != None:
+		# MAX Drive saves are normally decompressed as the
+		# files are asked for
+		for i in range(len(sf)):
+			sf.get_file(i)
+	return sf
+
 def do_import(args, mc, parser):
 	filenames = glob_args(args.savefile, glob)
 	if args.directory != None and len(filenames) > 1:
 		parser.error("The -d option can only be used with a"
 			     "single savefile.")
-
-	for filename in filenames:
-		sf = ps2save.ps2_save_file()
-		f = open(filename, "rb")
-		try:
-			ftype = ps2save.detect_file_type(f)
-			f.seek(0)
-			if ftype == "max":
-				sf.load_max_drive(f)
-			elif ftype == "psu":
-				sf.load_ems(f)
-			elif ftype == "cbs":
-				sf.load_codebreaker(f)
-			elif ftype == "sps":
-				sf.load_sharkport(f)
-			elif ftype == "npo":
-				raise io_error(EIO, "nPort saves"
-					       " are not supported.",
-					       filename)
+	if args.jobs < 1:
+		parser.error("The number of jobs must be at least 1.")
+
+	executor = None
+	if args.jobs > 1:
+		executor = ProcessPoolExecutor(args.jobs)
+	jobs = {}
+	next_job = 0
+	try:
+		for (i, filename) in enumerate(filenames):
+			if executor == None:
+				sf = _load_save_file(filename)
 			else:
-				raise io_error(EIO, "Save file format not"
-					       " recognized", filename)
-		finally:
-			f.close()
-		dirname = args.directory
-		if dirname == None:
-			dirname = sf.get_directory()[8].decode()
-			target = None
-		else:
+				# keep the workers busy decoding the save
+				# files that come after this one.  EMS
+				# saves are streamed in by this process.
+				while (next_job < len(filenames)
+				       and next_job < i + 2 * args.jobs):
+					name = filenames[next_job]
+					job = None
+					if not _is_ems_save_file(name):
+						job = executor.submit(
+							_decode_save_file,
+							name)
+					jobs[next_job] = job
+					next_job += 1
+				job = jobs.pop(i)
+				sf = None
+				if job != None:
+					sf = job.result()
+
+			if sf == None:
+				f = open(filename, "rb")
+				try:
+					_import_save_ems(args, mc, filename, f)
+				finally:
+					f.close()
+				continue
+
 			dirname = args.directory
-			target = args.directory.encode()
-		print("Importing", filename, "to", dirname)
-		if not mc.import_save_file(sf, args.ignore_existing,
-						target):
-			print((filename + ": already in memory card image,"
-			       " ignored."))
+			if dirname == None:
+				dirname = sf.get_directory()[8].decode()
+				target = None
+			else:
+				dirname = args.directory
+				target = args.directory.encode()
+			print("Importing", filename, "to", dirname)
+			if not mc.import_save_file(sf, args.ignore_existing,
+						   target):
+				print((filename + ": already in memory card"
+				       " image, ignored."))
+	finally:
+		if executor != None:
+			executor.shutdown(cancel_futures = True)
+
+def _import_save_ems(args, mc, filename, f):
+	dirname = args.directory
+	target = None
+	if dirname == None:
+		dirname = ps2save.read_ems_header(f)[8].decode()
+		f.seek(0)
+	else:
+		target = dirname.encode()
+	print("Importing", filename, "to", dirname)
+	if not mc.import_save_file_ems(f, args.ignore_existing, target):
+		print((filename + ": already in memory card image,"
+		       " ignored."))
 
 #re_num = re.compile("[0-9]+")
 
@@ -234,14 +324,62 @@ def do_export(args, mc, parser):
 		if args.longnames:
 			parser.error("The -o and -l options are mutually exclusive.")
 
+	if args.jobs < 1:
+		parser.error("The number of jobs must be at least 1.")
+
 	if args.directory != None:
 		os.chdir(args.directory)
 
+	if args.max_drive and args.cbs:
+		parser.error("The -m and -c options are mutually exclusive.")
+
 	type = "psu"
 	if args.max_drive:
 		type = "max"
+	elif args.cbs:
+		type = "cbs"
+	if args.jobs > 1:
+		executor = ProcessPoolExecutor(args.jobs)
+	else:
+		executor = None
+	jobs = []
+	try:
+		_export_saves(args, mc, dirnames, type, executor, jobs)
+		# wait for the exports in order, stopping at the first
+		# one that fails
+		for job in jobs:
+			job.result()
+	finally:
+		if executor != None:
+			# exports still queued after an error aren't started
+			executor.shutdown(cancel_futures = True)
+
+def _export_save(sf, filename, type, progress = True):
+	f = open(filename, "wb")
+	try:
+		if type == "max":
+			sf.save_max_drive(f, progress)
+		elif type == "cbs":
+			sf.save_codebreaker(f)
+		else:
+			sf.save_ems(f)
+	except:
+		f.close()
+		os.remove(filename)
+		raise
+	f.close()
+
+def _export_saves(args, mc, dirnames, type, executor, jobs):
 	for dirname in dirnames:
-		sf = mc.export_save_file(dirname)
+		# EMS saves can be copied straight from the memory card
+		# unless the long name, which needs all the data, is wanted
+		stream = type == "psu" and not args.longnames
+		if stream:
+			# make sure it exists before creating the file
+			mc.get_dirent(dirname)
+			sf = None
+		else:
+			sf = mc.export_save_file(dirname)
 		filename = args.output_file
 		if args.longnames:
 			filename = (ps2save.make_longname(dirname, sf).decode()
@@ -260,16 +398,26 @@ def do_export(args, mc, parser):
 					continue
 				raise io_error(EEXIST, "File exists", filename)
 
-		f = open(filename, "wb")
-		try:
-			print("Exporting", dirname.decode(), "to", filename)
+		print("Exporting", dirname.decode(), "to", filename)
+		if stream:
+			_export_save_ems(mc, dirname, filename)
+		elif executor != None:
+			# the save is read here, but compressed and
+			# written in another process
+			jobs.append(executor.submit(_export_save, sf,
+						    filename, type, False))
+		else:
+			_export_save(sf, filename, type)
 
-			if type == "max":
-				sf.save_max_drive(f)
-			else:
-				sf.save_ems(f)
-		finally:
-			f.close()
+def _export_save_ems(mc, dirname, filename):
+	f = open(filename, "wb")
+	try:
+		mc.export_save_file_ems(dirname, f)
+	except:
+		f.close()
+		os.remove(filename)
+		raise
+	f.close()
 
 def do_delete(args, mc, parser):
 	dirnames = [a.encode() for a in args.dirname]
@@ -398,9 +546,20 @@ def do_df(args, mc, parser):
 	print(mc.f.name + ":", mc.get_free_space(), "bytes free.")
 
 def do_check(args, mc, parser):
-	if mc.check():
+	report = mc.check(args.repair)
+	for line in report.lines():
+		print(line)
+	if report:
 		print("No errors found.")
 		return 0
+	if args.repair:
+		report = mc.check()
+		if report:
+			print("Errors repaired.")
+			return 0
+		print("Errors remaining after repair:")
+		for line in report.lines():
+			print(line)
 	return 1
 
 def do_format(args, mcname, parser):
@@ -409,7 +568,7 @@ def do_format(args, mcname, parser):
 		pages_per_cluster = (ps2mc.PS2MC_CLUSTER_SIZE
 				     // ps2mc.PS2MC_STANDARD_PAGE_SIZE)
 		pages_per_card = args.clusters * pages_per_cluster
-	params = (not args.no_ecc,
+	params = (not (args.no_ecc or args.sparse),
 		  ps2mc.PS2MC_STANDARD_PAGE_SIZE,
 		  ps2mc.PS2MC_STANDARD_PAGES_PER_ERASE_BLOCK,
 		  pages_per_card)
@@ -425,7 +584,7 @@ def do_format(args, mcname, parser):
 
 	f = open(mcname, "w+b")
 	try:
-		ps2mc.ps2mc(f, True, params).close()
+		ps2mc.ps2mc(f, True, params, sparse = args.sparse).close()
 	finally:
 		f.close()
 
@@ -442,6 +601,88 @@ def do_create_pad(args, mc, parser):
 		f.close()
 
 
+# options given before the command that apply to the whole session
+_global_options = ["debug", "ignore_ecc", "mmap", "fat_cache_size",
+		   "cluster_cache_size", "cache_stats", "journal"]
+
+def _shell_command(args, mc, parser, words):
+	"""Run one shell command against the open memory card."""
+
+	try:
+		cmd_args = parser.parse_args([args.memory_card] + words)
+	except SystemExit as value:
+		# argparse has already printed the error or the help
+		return value.code
+	for name in _global_options:
+		setattr(cmd_args, name, getattr(args, name))
+	if cmd_args.file_mode == None or cmd_args.func == do_shell:
+		write_error(words[0], "command can't be used in the shell")
+		return 1
+
+	cwd = os.getcwd()
+	curdir = mc.curdir
+	try:
+		return cmd_args.func(cmd_args, mc, parser)
+	except SystemExit as value:
+		return value.code
+	except EnvironmentError as value:
+		if args.debug:
+			raise
+		filename = getattr(value, "filename", None)
+		if filename == None:
+			filename = args.memory_card
+		write_error(filename, str(getattr(value, "strerror", None)
+					  or value))
+	except (ps2mc.error, ps2save.error) as value:
+		if args.debug:
+			raise
+		filename = getattr(value, "filename", None)
+		if filename == None:
+			filename = args.memory_card
+		write_error(filename, str(value))
+	finally:
+		os.chdir(cwd)
+		mc.curdir = curdir
+	return 1
+
+def do_shell(args, mc, parser):
+	if args.script == None or args.script == "-":
+		f = sys.stdin
+	else:
+		f = open(args.script, "r")
+	interactive = f.isatty()
+	ret = 0
+	try:
+		while True:
+			if interactive:
+				sys.stdout.write("mymc> ")
+				sys.stdout.flush()
+			line = f.readline()
+			if line == "":
+				if interactive:
+					print()
+				break
+			try:
+				words = shlex.split(line, comments = True)
+			except ValueError as value:
+				write_error(None, str(value))
+				words = None
+				r = 1
+			else:
+				if words == []:
+					continue
+				if words[0] in ["exit", "quit"]:
+					break
+				r = _shell_command(args, mc, parser, words)
+			if r != None and r != 0:
+				ret = 1
+				if not interactive and not args.keep_going:
+					break
+	finally:
+		if f != sys.stdin:
+			f.close()
+	return ret
+
 def do_frob(args, mc, parser):
 	mc.write_superblock()
 
@@ -477,6 +718,15 @@ def do_ecc_check(args, mc, parser):
 			print("bad: %05x" % i)
 
 
+def print_cache_stats(stats):
+	for name in ["fat", "alloc"]:
+		s = stats[name]
+		sys.stderr.write("%s cache: %d/%d used, %d hits, %d misses,"
+				 " %d evictions, %d write-backs\n"
+				 % (name, s["used"], s["length"], s["hits"],
+				    s["misses"], s["evictions"],
+				    s["write_backs"]))
+
 def write_error(filename, msg):
 	if isinstance(filename, bytes):
 		filename = filename.decode()
@@ -489,6 +739,20 @@ if __name__ == '__main__':
 	parser.add_argument('-D', '--debug', action='store_true')
 	parser.add_argument('-i', '--ignore-ecc', action='store_true',
 			    help="Ignore ECC errors while reading.")
+	parser.add_argument('-M', '--mmap', action='store_true',
+			    help="Access the memory card image through"
+			    " a memory map.")
+	parser.add_argument('--fat-cache-size', metavar="N", type=int,
+			    default=ps2mc.PS2MC_FAT_CACHE_SIZE,
+			    help="Number of FAT clusters to cache.")
+	parser.add_argument('--cluster-cache-size', metavar="N", type=int,
+			    default=ps2mc.PS2MC_ALLOC_CACHE_SIZE,
+			    help="Number of data clusters to cache.")
+	parser.add_argument('--cache-stats', action='store_true',
+			    help="Print cache statistics on exit.")
+	parser.add_argument('-J', '--journal', action='store_true',
+			    help="Write changes to a journal file before"
+			    " writing them to the memory card image.")
 	parser.add_argument('-v', '--version', action='version',
 			    version=("mymc "
 				     + verbuild.MYMC_VERSION_MAJOR
@@ -541,6 +805,10 @@ if __name__ == '__main__':
 	parser_import.add_argument("-i", "--ignore-existing", action="store_true",
 				   help=("Ignore files that already exist"
 					 " on the image."))
+	parser_import.add_argument("-j", "--jobs", type=int, default=1,
+				   metavar="N",
+				   help="Decode up to N save files at the"
+				   " same time.")
 	parser_import.add_argument('savefile', nargs='+', default=[])
 	parser_import.set_defaults(file_mode="r+b")
 	parser_import.set_defaults(func=do_import)
@@ -556,12 +824,18 @@ if __name__ == '__main__':
 	group = parser_export.add_mutually_exclusive_group()
 	group.add_argument("-l", "--longnames", action="store_true",
 			   help=("Generate longer, more descriptive, filenames."))
+	parser_export.add_argument("-j", "--jobs", type=int, default=1,
+				   metavar="N",
+				   help="Compress and write up to N save files"
+				   " at the same time.")
 	parser_export.add_argument("-m", "--max-drive", action="store_true",
 				   help="Use the MAX Drive save file format.")
 	group.add_argument("-o", "--output-file", metavar="filename",
 			   help='Use "filename" as the name of the save file.')
 	parser_export.add_argument("-p", "--ems", action="store_true",
 				   help="Use the EMS .psu save file format. [default]")
+	parser_export.add_argument("-c", "--cbs", action="store_true",
+				   help="Use the Codebreaker save file format.")
 	parser_export.add_argument('dirname', nargs='+', default=[])
 	parser_export.set_defaults(file_mode="rb")
 	parser_export.set_defaults(func=do_export)
@@ -628,14 +902,28 @@ if __name__ == '__main__':
 	parser_df.set_defaults(func=do_df)
 
 	parser_check = subparsers.add_parser("check", help="Check for file system errors.")
+	parser_check.add_argument("-r", "--repair", action="store_true",
+				  help="Repair the errors found.")
 	parser_check.set_defaults(file_mode="rb")
 	parser_check.set_defaults(func=do_check)
 
+	parser_shell = subparsers.add_parser("shell", aliases=["batch"],
+					     help="Run commands read from"
+					     " standard input or a script file.")
+	parser_shell.add_argument("-k", "--keep-going", action="store_true",
+				  help="Keep running commands after one fails.")
+	parser_shell.add_argument("script", nargs="?",
+				  help='Read commands from "script".')
+	parser_shell.set_defaults(file_mode="r+b")
+	parser_shell.set_defaults(func=do_shell)
+
 	parser_format = subparsers.add_parser("format", help="Creates a new memory card image.")
 	parser_format.add_argument("-c", "--clusters", type=int,
 				   help="Size in clusters of the memory card.")
 	parser_format.add_argument("-e", "--no-ecc", action="store_true",
 				   help="Create an image without ECC")
+	parser_format.add_argument("-s", "--sparse", action="store_true",
+				   help="Create a sparse image file without ECC")
 	parser_format.add_argument("-f", "--overwrite-existing", action="store_true",
 				   help="Overwrite any existing file")
 	parser_format.set_defaults(file_mode=None)
@@ -664,6 +952,10 @@ if __name__ == '__main__':
 	parser_create_pad.set_defaults(func=do_create_pad)
 
 	args = parser.parse_args()
+	if getattr(args, "repair", False):
+		args.file_mode = "r+b"
+	if args.fat_cache_size < 1 or args.cluster_cache_size < 1:
+		parser.error("cache sizes must be at least 1")
 
 
 	f = None
@@ -677,10 +969,20 @@ if __name__ == '__main__':
 				ret = args.func(args, mcname, parser)
 			else:
 				f = open(mcname, args.file_mode)
-				mc = ps2mc.ps2mc(f, args.ignore_ecc)
-				ret = args.func(args, mc, parser)
+				mc = ps2mc.ps2mc(f, args.ignore_ecc,
+						 use_mmap = args.mmap,
+						 fat_cache_size
+						 = args.fat_cache_size,
+						 alloc_cache_size
+						 = args.cluster_cache_size,
+						 journal = args.journal)
+				with mc.transaction():
+					ret = args.func(args, mc, parser)
 		finally:
 			if mc != None:
+				if args.cache_stats and mc.fat_cache != None:
+					mc.flush()
+					print_cache_stats(mc.cache_stats())
 				mc.close()
 			if f != None:
 				# print "f.close()"
@@ -10,12 +10,16 @@
 _SCCS_ID = "@(#) mymc ps2mc.py 1.11 22/01/15 01:17:07\n"
 
 import sys
+import os
 import array
 import struct
+import binascii
 from errno import EACCES, ENOENT, EEXIST, ENOTDIR, EISDIR, EROFS, ENOTEMPTY,\
      ENOSPC, EIO, EBUSY, EINVAL
 import fnmatch
 import traceback
+import mmap
+from collections import OrderedDict
 
 from round import *
 from ps2mc_ecc import *
@@ -35,6 +39,24 @@ PS2MC_STANDARD_PAGE_SIZE = 512
 PS2MC_STANDARD_PAGES_PER_CARD = 16384
 PS2MC_STANDARD_PAGES_PER_ERASE_BLOCK = 16
 
+PS2MC_PATH_CACHE_SIZE = 1024
+PS2MC_FAT_CACHE_SIZE = 12
+PS2MC_ALLOC_CACHE_SIZE = 64
+
+# number of bytes copied at a time when importing EMS save files
+PS2MC_IMPORT_CHUNK_SIZE = 64 * PS2MC_CLUSTER_SIZE
+
+# number of erased pages written at a time when formatting
+PS2MC_FORMAT_CHUNK_PAGES = 1024
+
+PS2MC_JOURNAL_MAGIC = b"PS2MCJNL"
+PS2MC_JOURNAL_END = b"JNLCOMIT"
+
+# magic, cluster size, number of clusters
+_journal_header_struct = struct.Struct("<8sLL")
+# end marker, CRC-32 of everything before it
+_journal_trailer_struct = struct.Struct("<8sL")
+
 class error(Exception):
 	pass
 
@@ -115,6 +137,9 @@ def pack_superblock(sb):
 unpack_fat = unpack_32bit_array
 pack_fat = pack_32bit_array
 
+# maps the most significant byte of a FAT entry to 1 if it's unallocated
+_fat_free_trans = bytes([int(b & 0x80 == 0) for b in range(256)])
+
 def pathname_split(pathname):
 	if pathname == b"":
 		return (None, False, False)
@@ -125,73 +150,100 @@ def pathname_split(pathname):
 		components[0] != b"",
 		components[-1] == b"")
 
+class _cache_entry:
+	__slots__ = ["value", "dirty"]
+
+	def __init__(self, value, dirty):
+		self.value = value
+		self.dirty = dirty
+
 class lru_cache:
-	def __init__(self, length):
-		self._lru_list = [[i - 1, None, None, i + 1]
-				  for i in range(length + 1)]
-		self._index_map = {}
+	"""A least recently used cache with write-back of dirty entries.
+
+	When a dirty entry is evicted or flushed, write_back is called
+	with its key and value.  Counts of hits, misses, evictions and
+	write-backs are kept for tuning the cache size."""
+
+	__slots__ = ["length", "write_back", "_entries",
+		     "hits", "misses", "evictions", "write_backs"]
+
+	def __init__(self, length, write_back = None):
+		if length < 1:
+			raise ValueError("cache length must be at least 1")
+		self.length = length
+		self.write_back = write_back
+		self._entries = OrderedDict()
+		self.hits = 0
+		self.misses = 0
+		self.evictions = 0
+		self.write_backs = 0
+
+	def __len__(self):
+		return len(self._entries)
 
 	def dump(self):
-		lru_list = self._lru_list
-		i = 0
-		while i != len(self._lru_list):
-			print("%d: %s, " % (i, str(lru_list[i][1])), end=' ')
-			i = lru_list[i][3]
+		for (key, entry) in reversed(self._entries.items()):
+			print("%s%s, " % (str(key), "*" * entry.dirty), end=' ')
 		print()
-		print(self._index_map)
-
-	def _move_to_front(self, i):
-		lru_list = self._lru_list
-		first = lru_list[0]
-		i2 = first[3]
-		if i != i2:
-			elt = lru_list[i]
-			prev = lru_list[elt[0]]
-			next = lru_list[elt[3]]
-			prev[3] = elt[3]
-			next[0] = elt[0]
-			elt[0] = 0
-			elt[3] = i2
-			lru_list[i2][0] = i
-			first[3] = i
-
-	def add(self, key, value):
-		lru_list = self._lru_list
-		index_map = self._index_map
-		ret = None
-		if key in index_map:
-			i = index_map[key]
-			# print "add hit ", key, i
-			elt = lru_list[i]
-		else:
-			# print "add miss", key
-			i = lru_list[-1][0]
-			elt = lru_list[i]
-			old_key = elt[1]
-			if old_key != None:
-				del index_map[old_key]
-				ret = (old_key, elt[2])
-			index_map[key] = i
-			elt[1] = key
-		elt[2] = value
-		self._move_to_front(i)
+		print(self.stats())
 
-		return ret
+	def add(self, key, value, dirty = False):
+		"""Add or replace an entry, evicting the least recently
+		used entry if the cache is full.
+
+		Returns the evicted (key, value, dirty) tuple or None."""
+
+		entries = self._entries
+		entry = entries.get(key)
+		if entry != None:
+			entry.value = value
+			entry.dirty = entry.dirty or dirty
+			entries.move_to_end(key)
+			return None
+		entries[key] = _cache_entry(value, dirty)
+		if len(entries) <= self.length:
+			return None
+		(old_key, old) = entries.popitem(last = False)
+		self.evictions += 1
+		if old.dirty and self.write_back != None:
+			self.write_backs += 1
+			self.write_back(old_key, old.value)
+		return (old_key, old.value, old.dirty)
 
 	def get(self, key, default = None):
-		i = self._index_map.get(key)
-		if i == None:
-			# print "get miss", key
+		entry = self._entries.get(key)
+		if entry == None:
+			self.misses += 1
 			return default
-		# print "get hit ", key, i
-		ret = self._lru_list[i][2]
-		self._move_to_front(i)
-		return ret
+		self.hits += 1
+		self._entries.move_to_end(key)
+		return entry.value
 
 	def items(self):
-		return [(elt[1], elt[2])
-			for elt in self._lru_list[1 : -1]
-			if elt[2] != None]
+		return [(key, entry.value)
+			for (key, entry) in self._entries.items()]
+
+	def take_dirty(self):
+		"""Return the dirty entries sorted by key, and mark them clean.
+
+		The caller is responsible for writing them back."""
+
+		dirty = []
+		for (key, entry) in self._entries.items():
+			if entry.dirty:
+				dirty.append((key, entry.value))
+				entry.dirty = False
+		self.write_backs += len(dirty)
+		dirty.sort(key = lambda item: item[0])
+		return dirty
+
+	def stats(self):
+		return {"length": self.length,
+			"used": len(self._entries),
+			"hits": self.hits,
+			"misses": self.misses,
+			"evictions": self.evictions,
+			"write_backs": self.write_backs}
 
 class fat_chain:
 	"""A class for accessing a file's FAT entries as a simple sequence."""
@@ -257,6 +309,62 @@ class fat_chain:
 		self.offset = old_offset
 		return i
 
+class dir_name_index:
+	"""An index of the names of the entries in a directory.
+
+	Maps the name of every entry that exists in a directory to its
+	index in the directory, so a name can be found without reading
+	through the entire directory."""
+
+	def __init__(self, dir):
+		self.names = {}
+		self.slots = {}
+		self.duplicates = False
+
+		f = dir.f
+		pos = f.tell()
+		f.seek(0)
+		s = f.read(f.length)
+		f.seek(pos)
+		if len(s) != f.length:
+			raise corrupt("Corrupt directory", f)
+		for i in range(len(s) // PS2MC_DIRENT_LENGTH):
+			off = i * PS2MC_DIRENT_LENGTH
+			(mode,) = struct.unpack_from("<H", s, off)
+			if mode & DF_EXISTS:
+				name = zero_terminate(s[off + 64
+							: off + PS2MC_DIRENT_LENGTH])
+				self.add(i, name)
+
+	def add(self, i, name):
+		self.slots[i] = name
+		if self.names.setdefault(name, i) != i:
+			self.duplicates = True
+
+	def remove(self, i):
+		"""Remove an entry from the index.
+
+		Returns False if the index can no longer be used."""
+
+		name = self.slots.pop(i, None)
+		if name != None and self.names.get(name) == i:
+			if self.duplicates:
+				return False
+			del self.names[name]
+		return True
+
+	def find(self, name):
+		return self.names.get(name)
+
+	def free_slot(self, length):
+		"""Return the index of the first unused entry."""
+
+		slots = self.slots
+		for i in range(length):
+			if i not in slots:
+				return i
+		return length
+
 class ps2mc_file:
 	"""A file-like object for accessing a file in memory card image."""
 
@@ -272,6 +380,8 @@ class ps2mc_file:
 		self.buffer = None
 		self.buffer_cluster = None
 		self.softspace = 0
+		self._length_changed = False
+		self._modified = False
 		if name == None:
 			self.name = "<ps2mc_file>"
 		elif isinstance(name, bytes):
@@ -306,23 +416,54 @@ class ps2mc_file:
 		self.buffer_cluster = n
 		return self.buffer
 
-	def _extend_file(self, n):
+	def _extend_file(self, n, count):
+		"""Add count new clusters to the end of the file's chain,
+		which is n clusters long."""
+
 		mc = self.mc
-		cluster = mc.allocate_cluster()
-		# print "@@@ extending file", n, cluster
-		if cluster == None:
+		clusters = mc.allocate_clusters(count)
+		# print "@@@ extending file", n, clusters
+		if clusters == None:
 			return None
 		if n == 0:
-			self.first_cluster = cluster
+			self.first_cluster = clusters[0]
 			self.fat_chain = None
-			# print "@@@ linking", self.dirloc, "->", cluster
-			mc.update_dirent(self.dirloc, self, cluster,
+			# print "@@@ linking", self.dirloc, "->", clusters[0]
+			mc.update_dirent(self.dirloc, self, clusters[0],
 					 None, False)
 		else:
 			prev = self.fat_chain[n - 1]
-			# print "@@@ linking", prev, "->", cluster
-			mc.set_fat(prev, cluster | PS2MC_FAT_ALLOCATED_BIT)
-		return cluster
+			# print "@@@ linking", prev, "->", clusters[0]
+			mc.set_fat(prev, clusters[0] | PS2MC_FAT_ALLOCATED_BIT)
+		return clusters
+
+	def _chain_length(self):
+		"""Return the number of clusters in the file's chain."""
+
+		cluster_size = self.mc.cluster_size
+		file_cluster_end = div_round_up(self.length, cluster_size)
+		self._find_file_cluster(0)
+		chain_end = len(self.fat_chain)
+		if chain_end < file_cluster_end:
+			raise corrupt("file length doesn't match cluster"
+				      " chain length", self.mc.f)
+		return chain_end
+
+	def reserve(self, length):
+		"""Allocate enough clusters for the file to grow to length.
+
+		The clusters are allocated all at once, in one contiguous
+		run if possible.  Used when the final size of a file is
+		known before it's written."""
+
+		if self.closed:
+			raise ValueError("file is closed")
+
+		chain_end = self._chain_length()
+		count = div_round_up(length, self.mc.cluster_size) - chain_end
+		if count > 0 and self._extend_file(chain_end, count) == None:
+			raise io_error(ENOSPC, "out of space on image",
+				       self.name)
 
 	def write_file_cluster(self, n, buf):
 		mc = self.mc
@@ -334,30 +475,15 @@ class ps2mc_file:
 			return True
 
 		cluster_size = mc.cluster_size
-		file_cluster_end = div_round_up(self.length, cluster_size)
-
-		if (cluster < file_cluster_end
-		    or len(self.fat_chain) != file_cluster_end):
-			raise corrupt("file length doesn't match cluster"
-				      " chain length", mc.f)
-
-		for i in range(file_cluster_end, n):
-			cluster = self._extend_file(i)
-			if cluster == None:
-				if i != file_cluster_end:
-					self.length = (i - 1) * cluster_size
-					mc.update_dirent(self.dirloc, self,
-							 None, self.length,
-							 True)
-				return False
+		chain_end = self._chain_length()
+		clusters = self._extend_file(chain_end, n - chain_end + 1)
+		if clusters == None:
+			return False
+		for cluster in clusters[:-1]:
 			mc.write_allocatable_cluster(
 				cluster, bytearray(b"\0") * cluster_size)
 
-		cluster = self._extend_file(n)
-		if cluster == None:
-			return False
-
-		mc.write_allocatable_cluster(cluster, buf)
+		mc.write_allocatable_cluster(clusters[-1], buf)
 		self.buffer = buf
 		self.buffer_cluster = n
 		return True
@@ -370,6 +496,31 @@ class ps2mc_file:
 		self.buffer = None
 		self.buffer_cluster = None
 
+	def readinto(self, b):
+		"""Read data into a preallocated, writable buffer.
+
+		Returns the number of bytes read."""
+
+		if self.closed:
+			raise ValueError("file is closed")
+
+		out = memoryview(b).cast("B")
+		pos = self._pos
+		cluster_size = self.mc.cluster_size
+		size = max(min(self.length - pos, len(out)), 0)
+		n = 0
+		while n < size:
+			off = pos % cluster_size
+			l = min(cluster_size - off, size - n)
+			buf = self.read_file_cluster(pos // cluster_size)
+			if buf == None:
+				break
+			out[n : n + l] = memoryview(buf)[off : off + l]
+			pos += l
+			n += l
+		self._pos = pos
+		return n
+
 	def read(self, size = None, eol = None):
 		if self.closed:
 			raise ValueError("file is closed")
@@ -379,7 +530,9 @@ class ps2mc_file:
 		if size == None:
 			size = self.length
 		size = max(min(self.length - pos, size), 0)
-		ret = b""
+		# Collect views of the cached clusters so each byte is
+		# only copied once, when they're joined together.
+		ret = []
 		while size > 0:
 			off = pos % cluster_size
 			l = min(cluster_size - off, size)
@@ -389,13 +542,13 @@ class ps2mc_file:
 			if eol != None:
 				i = buf.find(eol, off, off + l)
 				if i != -1:
-					l = off - i + 1
+					l = i - off + 1
 					size = l
 			pos += l
-			self._pos = pos
-			ret += buf[off : off + l]
+			ret.append(memoryview(buf)[off : off + l])
 			size -= l
-		return ret
+		self._pos = pos
+		return b"".join(ret)
 
 	def write(self, out, _set_modified = True):
 		if self.closed:
@@ -411,6 +564,16 @@ class ps2mc_file:
 
 		size = len(out)
 		# print "@@@ write", pos, size
+		if pos + size > self.length:
+			chain_end = self._chain_length()
+			self.reserve(pos + size)
+			# clusters skipped over by seeking past the end
+			# of the file must read back as zeros
+			zero = bytes(cluster_size)
+			mc = self.mc
+			for n in range(chain_end, pos // cluster_size):
+				mc.write_allocatable_cluster(
+					self._find_file_cluster(n), zero)
 		i = 0
 		while size > 0:
 			cluster = pos // cluster_size
@@ -419,9 +582,12 @@ class ps2mc_file:
 			s = out[i : i + l]
 			pos += l
 			if l == cluster_size:
-				buf = s
+				buf = bytes(s)
 			else:
-				buf = self.read_file_cluster(cluster)
+				buf = None
+				if cluster * cluster_size < self.length:
+					# keep the existing contents
+					buf = self.read_file_cluster(cluster)
 				if buf == None:
 					buf = b"\0" * cluster_size
 				buf = buf[:off] + s + buf[off + l:]
@@ -431,18 +597,37 @@ class ps2mc_file:
 					       self.name)
 			self._pos = pos
 			# print "@@@ pos", pos
-			new_length = None
 			if pos > self.length:
-				new_length = self.length = pos
-			self.mc.update_dirent(self.dirloc, self, None,
-					      new_length, _set_modified)
+				self.length = pos
+				self._length_changed = True
+			if _set_modified:
+				self._modified = True
 
 			i += l
 			size -= l
 
+	def flush(self):
+		"""Update the file's directory entry.
+
+		Writing to a file only updates its length and modification
+		time in memory, they're written to its directory entry when
+		the file is flushed or closed."""
+
+		if self.mc == None:
+			return
+		length = None
+		if self._length_changed:
+			length = self.length
+		modified = self._modified
+		self._length_changed = False
+		self._modified = False
+		self.mc.update_dirent(self.dirloc, self, None, length,
+				      modified)
+
 	def close(self):
 		# print "ps2mc_file.close", self.name, self
 		if self.mc != None:
+			self.flush()
 			self.mc.notify_closed(self.dirloc, self)
 			self.mc = None
 		self.fat_chain = None
@@ -455,7 +640,7 @@ class ps2mc_file:
 		return r
 
 	def readline(self, size = None):
-		return self.read(size, "\n").decode()
+		return self.read(size, b"\n").decode()
 
 	def readlines(self, sizehint):
 		return [line for line in self]
@@ -510,9 +695,12 @@ class ps2mc_directory:
 
 	def write_raw_ent(self, index, ent, set_modified):
 		# print "@@@ write_raw_ent", index
+		mc = self.f.mc
 		self.seek(index)
 		self.f.write(pack_dirent(ent),
 			     _set_modified = set_modified)
+		self.f.flush()
+		mc.dirent_written(self.f.first_cluster, index, ent)
 
 	def __next__(self):
 		# print "@@@ next", self.tell(), self.f.name
@@ -584,6 +772,53 @@ class _root_directory(ps2mc_directory):
 	def real_close(self):
 		ps2mc_directory.close(self)
 
+class check_report:
+	"""The problems found by a file system check.
+
+	Errors are stored as (kind, pathname, reason, dirloc) tuples,
+	where kind is either "file" or "directory" and dirloc is the
+	location of the bad file or directory's entry."""
+
+	def __init__(self):
+		self.errors = []
+		self.lost_clusters = []
+		self.cross_linked = []
+
+	def add_error(self, kind, pathname, why, dirloc):
+		self.errors.append((kind, pathname, why, dirloc))
+
+	def __bool__(self):
+		return self.errors == [] and self.lost_clusters == []
+
+	def lines(self):
+		"""Return a description of the problems as a list of lines."""
+
+		lines = ["bad %s: %s: %s"
+			 % (kind, pathname.decode("ascii", "replace"), why)
+			 for (kind, pathname, why, dirloc) in self.errors]
+		if self.lost_clusters != []:
+			lines.append(" ".join(map(str, self.lost_clusters)))
+			lines.append("found %d lost clusters"
+				     % len(self.lost_clusters))
+		return lines
+
+class _transaction:
+	"""Defers flushing a ps2mc object until the end of a with block."""
+
+	def __init__(self, mc):
+		self.mc = mc
+
+	def __enter__(self):
+		self.mc.transaction_level += 1
+		return self.mc
+
+	def __exit__(self, type, value, traceback):
+		mc = self.mc
+		mc.transaction_level -= 1
+		if mc.transaction_level == 0 and mc.f != None:
+			mc.flush()
+		return False
+
 class ps2mc:
 	"""A PlayStation 2 memory card filesystem implementation.
 
@@ -592,7 +827,14 @@ class ps2mc:
 	will remain."""
 
 	open_files = None
+	dir_indexes = None
+	path_cache = None
 	fat_cache = None
+	alloc_cluster_cache = None
+	fat_table = None
+	image_map = None
+	transaction_level = 0
+	journal_name = None
 
 	def _calculate_derived(self):
 		self.spare_size = div_round_up(self.page_size, 128) * 4
@@ -607,13 +849,27 @@ class ps2mc:
 			 - self.allocatable_cluster_offset)
 		self.allocatable_cluster_limit = limit
 
-	def __init__(self, f, ignore_ecc = False, params = None):
+	def __init__(self, f, ignore_ecc = False, params = None,
+		     use_mmap = False,
+		     fat_cache_size = PS2MC_FAT_CACHE_SIZE,
+		     alloc_cache_size = PS2MC_ALLOC_CACHE_SIZE,
+		     journal = False, sparse = False):
 		self.open_files = {}
-		self.fat_cache = lru_cache(12)
-		self.alloc_cluster_cache = lru_cache(64)
+		self.dir_indexes = {}
+		self.path_cache = {}
 		self.modified = False
 		self.f = None
 		self.rootdir = None
+		self.image_map = None
+		self.fat_table = None
+		self.fat_cursor = 0
+		self.transaction_level = 0
+		self.journal_name = None
+		self.journal_pending = {}
+		self.fat_cache = lru_cache(fat_cache_size,
+					   self._write_back_fat_cluster)
+		self.alloc_cluster_cache = lru_cache(
+			alloc_cache_size, self._write_back_alloc_cluster)
 
 		f.seek(0)
 		s = f.read(0x154)
@@ -622,7 +878,12 @@ class ps2mc:
 				raise corrupt("Not a PS2 memory card image",
 					      f)
 			self.f = f
-			self.format(params)
+			journal_name = self._journal_filename(f, journal)
+			if journal_name != None and os.path.exists(journal_name):
+				# left over from a previous image
+				os.remove(journal_name)
+				self._sync_journal_dir(journal_name)
+			self.format(params, sparse)
 		else:
 			sb = unpack_superblock(s)
 			self.version = sb[1]
@@ -653,6 +914,17 @@ class ps2mc:
 				self.raw_page_size = self.page_size
 				ignore_ecc = True
 
+			journal_name = self._journal_filename(f, journal)
+			if journal_name != None and os.path.exists(journal_name):
+				self._replay_journal(journal_name)
+
+			self._load_fat()
+
+		if journal:
+			self.journal_name = journal_name
+		if use_mmap:
+			self._map_image()
+
 		# sanity check
 		root = self._directory(None, 0, 1)
 		dot = root[0]
@@ -662,9 +934,149 @@ class ps2mc:
 		    or not mode_is_dir(dot[0]) or not mode_is_dir(dotdot[0])):
 			raise corrupt("Root directory damaged.")
 
-		self.fat_cursor = 0
 		self.curdir = (0, 0)
 
+	def _journal_filename(self, f, journal):
+		name = getattr(f, "name", None)
+		if not isinstance(name, str):
+			if journal:
+				raise error("a journal can only be used with"
+					    " an image file that has a name")
+			return None
+		# absolute, so changing directories can't lose it
+		return os.path.abspath(name + ".journal")
+
+	def _sync_journal_dir(self, journal_name):
+		"""Make sure the journal being created or removed is
+		recorded in its directory on disk."""
+
+		if os.name == "nt":
+			# directories can't be opened and fsync'ed
+			return
+		fd = os.open(os.path.dirname(journal_name), os.O_RDONLY)
+		try:
+			os.fsync(fd)
+		finally:
+			os.close(fd)
+
+	def _is_writable(self):
+		mode = getattr(self.f, "mode", "rb")
+		return "+" in mode or "w" in mode or "a" in mode
+
+	def _write_journal(self, clusters):
+		"""Write clusters about to be written to the image to the
+		journal, and make sure it's on disk before continuing."""
+
+		s = [_journal_header_struct.pack(PS2MC_JOURNAL_MAGIC,
+						 self.cluster_size,
+						 len(clusters))]
+		for (n, buf) in clusters:
+			s.append(struct.pack("<L", n))
+			s.append(buf)
+		s = b"".join(s)
+		s += _journal_trailer_struct.pack(PS2MC_JOURNAL_END,
+						  binascii.crc32(s) & 0xFFFFFFFF)
+		f = open(self.journal_name, "wb")
+		try:
+			f.write(s)
+			f.flush()
+			os.fsync(f.fileno())
+		finally:
+			f.close()
+		self._sync_journal_dir(self.journal_name)
+
+	def _read_journal(self, s):
+		"""Return the clusters in a journal, or None if it's
+		incomplete."""
+
+		header_size = _journal_header_struct.size
+		trailer_size = _journal_trailer_struct.size
+		if len(s) < header_size + trailer_size:
+			return None
+		(magic, cluster_size, count) \
+			= _journal_header_struct.unpack_from(s)
+		record_size = 4 + cluster_size
+		end = len(s) - trailer_size
+		if (magic != PS2MC_JOURNAL_MAGIC
+		    or cluster_size != self.cluster_size
+		    or end != header_size + count * record_size):
+			return None
+		(marker, crc) = _journal_trailer_struct.unpack_from(s, end)
+		if (marker != PS2MC_JOURNAL_END
+		    or crc != binascii.crc32(s[:end]) & 0xFFFFFFFF):
+			return None
+		clusters = []
+		for off in range(header_size, end, record_size):
+			(n,) = struct.unpack_from("<L", s, off)
+			clusters.append((n, s[off + 4 : off + record_size]))
+		return clusters
+
+	def _replay_journal(self, journal_name):
+		"""Finish writing the clusters recorded in a journal left
+		behind by an interrupted flush.
+
+		A journal that wasn't completely written is discarded,
+		as nothing in the image was changed."""
+
+		f = open(journal_name, "rb")
+		try:
+			clusters = self._read_journal(f.read())
+		finally:
+			f.close()
+		if clusters != None:
+			if not self._is_writable():
+				raise corrupt("image has an unfinished journal,"
+					      " it must be opened for writing"
+					      " to recover", self.f)
+			self._write_dirty_clusters(clusters)
+			self.f.flush()
+			os.fsync(self.f.fileno())
+		os.remove(journal_name)
+		self._sync_journal_dir(journal_name)
+
+	def _map_image(self):
+		"""Access the image through a memory map if possible."""
+
+		f = self.f
+		if self._is_writable():
+			access = mmap.ACCESS_WRITE
+		else:
+			access = mmap.ACCESS_READ
+		try:
+			f.flush()
+			self.image_map = mmap.mmap(f.fileno(), 0,
+						   access = access)
+		except (AttributeError, OSError, ValueError):
+			# not a real file, so use normal file I/O
+			self.image_map = None
+
+	def _read_raw(self, offset, length):
+		"""Read raw data from the image.
+
+		If the image is memory mapped a memoryview of the mapping
+		is returned, which must not be kept."""
+
+		image_map = self.image_map
+		if image_map == None:
+			f = self.f
+			f.seek(offset)
+			return f.read(length)
+		return memoryview(image_map)[offset : offset + length]
+
+	def _write_raw(self, offset, buf):
+		"""Write raw data to the image."""
+
+		image_map = self.image_map
+		if image_map == None:
+			f = self.f
+			f.seek(offset)
+			f.write(buf)
+			return
+		end = offset + len(buf)
+		if end > len(image_map):
+			raise corrupt("attempted to write past EOF", self.f)
+		image_map[offset : end] = buf
+
 	def write_superblock(self):
 		s = pack_superblock((PS2MC_MAGIC,
 				     self.version,
@@ -686,15 +1098,17 @@ class ps2mc:
 		self.write_page(0, s)
 
 		page = b"\xFF" * self.raw_page_size
-		self.f.seek(self.good_block2 * self.pages_per_erase_block
-			    * self.raw_page_size)
-		for i in range(self.pages_per_erase_block):
-			self.f.write(page)
+		self._write_raw(self.good_block2 * self.pages_per_erase_block
+				* self.raw_page_size,
+				page * self.pages_per_erase_block)
 
 		self.modified = False
 
-	def format(self, params):
-		"""Create (format) a new memory card image."""
+	def format(self, params, sparse = False):
+		"""Create (format) a new memory card image.
+
+		If sparse is true the image is created without ECC as a
+		sparse file, with only the non-empty pages written."""
 
 		(with_ecc, page_size,
 		 pages_per_erase_block, param_pages_per_card) = params
@@ -763,42 +1177,59 @@ class ps2mc:
 		self._calculate_derived()
 
 		self.ignore_ecc = not with_ecc
-		erased = b"\0" * page_size
 		if not with_ecc:
 			self.spare_size = 0
-		else:
-			ecc = "".join(["".join(map(chr, s))
-				       for s in ecc_calculate_page(erased)])
-			ecc = ecc.encode()
-			erased += ecc + b"\0" * (self.spare_size - len(ecc))
+			self.raw_page_size = page_size
+		elif sparse:
+			raise error("a sparse image can't have ECC")
 
-		self.f.seek(0)
-		for page in range(pages_per_card):
-			self.f.write(erased)
+		f = self.f
+		f.seek(0)
+		if sparse:
+			# erased pages are all zeros without ECC, so leave
+			# them as holes in the file.
+			f.truncate()
+			f.seek(pages_per_card * page_size - 1)
+			f.write(b"\0")
+		else:
+			erased = b"\0" * page_size
+			if with_ecc:
+				erased = ecc_encode_pages(erased, page_size,
+							  self.spare_size)
+			chunk = erased * PS2MC_FORMAT_CHUNK_PAGES
+			for page in range(0, pages_per_card,
+					  PS2MC_FORMAT_CHUNK_PAGES):
+				count = min(pages_per_card - page,
+					    PS2MC_FORMAT_CHUNK_PAGES)
+				if count != PS2MC_FORMAT_CHUNK_PAGES:
+					chunk = erased * count
+				f.write(chunk)
 
 		self.modified = True
 
+		# The indirect FAT clusters are followed immediately by
+		# the FAT clusters, so build them all in memory and
+		# write them out together.
 		first_fat_cluster = first_ifc + indirect_fat_clusters
-		remainder = fat_clusters % epc
-		for i in range(indirect_fat_clusters):
-			base = first_fat_cluster + i * epc
-			buf = unpack_fat(list(range(base, base + epc)))
-			if (i == indirect_fat_clusters - 1
-			    and remainder != 0):
-				del buf[remainder:]
-				buf.fromlist([0xFFFFFFFF] * (epc - remainder))
-			self._write_fat_cluster(ifc_list[i], buf)
-
-
-		# go through the fat backwards for better cache usage
-		for i in range(allocatable_clusters - 1,
-			       allocatable_cluster_end - 1, -1):
-			self.set_fat(i, PS2MC_FAT_CHAIN_END)
-		for i in range(allocatable_cluster_end - 1, 0, -1):
-			self.set_fat(i, PS2MC_FAT_CLUSTER_MASK)
-		self.set_fat(0, PS2MC_FAT_CHAIN_END)
+		indirect_fat = array.array('I', range(first_fat_cluster,
+						      first_fat_cluster
+						      + fat_clusters))
+		indirect_fat.extend([0xFFFFFFFF] * (indirect_fat_clusters * epc
+						    - fat_clusters))
+
+		table = array.array('I', [PS2MC_FAT_CHAIN_END])
+		table.extend([PS2MC_FAT_CLUSTER_MASK]
+			     * (allocatable_cluster_end - 1))
+		table.extend([PS2MC_FAT_CHAIN_END]
+			     * (allocatable_clusters - allocatable_cluster_end))
+
+		self.write_clusters(first_ifc, pack_fat(indirect_fat)
+				    + pack_fat(table))
 
 		self.allocatable_cluster_end = allocatable_cluster_end
+		self._set_fat_table(table, list(range(first_fat_cluster,
+						      first_fat_cluster
+						      + fat_clusters)))
 
 		now = tod_now()
 		s = pack_dirent((DF_RWX | DF_DIR | DF_0400 | DF_EXISTS,
@@ -817,127 +1248,196 @@ class ps2mc:
 
 	def read_page(self, n):
 		# print "@@@ page", n
-		f = self.f
-		f.seek(self.raw_page_size * n)
-		page = f.read(self.page_size)
-		if len(page) != self.page_size:
+		page_size = self.page_size
+		length = page_size
+		if not self.ignore_ecc:
+			length += self.spare_size
+		raw = self._read_raw(self.raw_page_size * n, length)
+		if len(raw) != length:
 			raise corrupt("attempted to read past EOF"
-				      " (page %05X)" % n, f)
+				      " (page %05X)" % n, self.f)
+		page = bytes(raw[:page_size])
 		if self.ignore_ecc:
 			return page
-		spare = f.read(self.spare_size)
-		if len(spare) != self.spare_size:
-			raise corrupt("attempted to read past EOF"
-				      " (page %05X)" % n, f)
-		(status, page, spare) = ecc_check_page(page, spare)
+		(status, page, spare) = ecc_check_page(page,
+						       bytes(raw[page_size:]))
 		if status == ECC_CHECK_FAILED:
 			raise ecc_error("Unrecoverable ECC error (page %d)"
 					% n)
 		return page
 
 	def write_page(self, n, buf):
-		f = self.f
-		f.seek(self.raw_page_size * n)
 		self.modified = True
 		if len(buf) != self.page_size:
 			raise error("internal error: write_page:"
 				    " %d != %d" % (len(buf), self.page_size))
-		f.write(buf)
 		if self.spare_size != 0:
-			a = array.array('B')
-			for s in ecc_calculate_page(buf):
-				a.fromlist(s)
-			a.tofile(f)
-			f.write(b"\0" * (self.spare_size - len(a)))
+			buf = ecc_encode_pages(buf, self.page_size,
+					       self.spare_size)
+		self._write_raw(self.raw_page_size * n, buf)
 
 	def read_cluster(self, n):
+		if self.journal_pending:
+			buf = self.journal_pending.get(n)
+			if buf != None:
+				return buf
 		pages_per_cluster = self.pages_per_cluster
 		cluster_size = self.cluster_size
 		if self.spare_size == 0:
-			self.f.seek(cluster_size * n)
-			return self.f.read(cluster_size)
+			return bytes(self._read_raw(cluster_size * n,
+						    cluster_size))
 		n *= pages_per_cluster
-		if pages_per_cluster == 2:
-			return self.read_page(n) + self.read_page(n + 1)
+		page_size = self.page_size
+		raw_page_size = self.raw_page_size
+		raw_size = raw_page_size * pages_per_cluster
+		raw = self._read_raw(raw_page_size * n, raw_size)
+		if len(raw) == raw_size:
+			if self.ignore_ecc:
+				return b"".join([raw[i : i + page_size]
+						 for i in range(0, raw_size,
+								raw_page_size)])
+			(status, buf) = ecc_check_pages(raw, page_size,
+							self.spare_size)
+			if status != ECC_CHECK_FAILED:
+				return buf
+		# let read_page() report the error
 		return b"".join(map(self.read_page,
 				    range(n, n + pages_per_cluster)))
 
 	def write_cluster(self, n, buf):
-		pages_per_cluster = self.pages_per_cluster
 		cluster_size = self.cluster_size
+		if len(buf) != cluster_size:
+			raise error("internal error: write_cluster:"
+				    " %d != %d" % (len(buf), cluster_size))
+		self.write_clusters(n, buf)
+
+	def write_clusters(self, n, buf):
+		"""Write a run of consecutive clusters starting at cluster n.
+
+		The ECC codes for all the pages are calculated together
+		and the run is written to the image in a single write."""
+
+		cluster_size = self.cluster_size
+		if len(buf) % cluster_size != 0:
+			raise error("internal error: write_clusters:"
+				    " %d %% %d != 0" % (len(buf), cluster_size))
 		if self.spare_size == 0:
-			self.f.seek(cluster_size * n)
-			if len(buf) != cluster_size:
-				raise error("internal error: write_cluster:"
-					    " %d != %d" % (len(buf),
-							   cluster_size))
-			return self.f.write(buf)
-		n *= pages_per_cluster
-		pgsize = self.page_size
-		for i in range(pages_per_cluster):
-			self.write_page(n + i, buf[i * pgsize
-						   : i * pgsize + pgsize])
+			self._write_raw(cluster_size * n, buf)
+			return
+		self.modified = True
+		self._write_raw(self.raw_page_size * self.pages_per_cluster * n,
+				ecc_encode_pages(buf, self.page_size,
+						 self.spare_size))
+
+	def _write_dirty_clusters(self, clusters):
+		"""Write a list of (cluster, data) pairs to the image.
 
+		The clusters are written in order of their position in
+		the image, with adjacent clusters merged into one write."""
 
-	def _add_fat_cluster_to_cache(self, n, fat, dirty):
-		old = self.fat_cache.add(n, [fat, dirty])
-		if old != None:
-			(n, [fat, dirty]) = old
-			if dirty:
-				self.write_cluster(n, pack_fat(fat))
+		clusters.sort(key = lambda item: item[0])
+		i = 0
+		while i < len(clusters):
+			(start, buf) = clusters[i]
+			run = [buf]
+			i += 1
+			while (i < len(clusters)
+			       and clusters[i][0] == start + len(run)):
+				run.append(clusters[i][1])
+				i += 1
+			# print "@@@ write run", start, len(run)
+			self.write_clusters(start, b"".join(run))
+
+	def _dirty_fat_clusters(self):
+		self._write_fat_table()
+		return [(n, pack_fat(fat))
+			for (n, fat) in self.fat_cache.take_dirty()]
+
+	def _dirty_alloc_clusters(self):
+		offset = self.allocatable_cluster_offset
+		return [(n + offset, buf)
+			for (n, buf) in self.alloc_cluster_cache.take_dirty()]
+
+
+	def _write_back_fat_cluster(self, n, fat):
+		if self.journal_name != None:
+			# hold on to it until it can be journaled
+			self.journal_pending[n] = pack_fat(fat)
+			return
+		self.write_cluster(n, pack_fat(fat))
 
 	def _read_fat_cluster(self, n):
-		v = self.fat_cache.get(n)
-		if v != None:
+		fat = self.fat_cache.get(n)
+		if fat != None:
 			# print "@@@ fat hit", n
-			return v[0]
+			return fat
 		# print "@@@ fat miss", n
 		fat = unpack_fat(self.read_cluster(n))
-		self._add_fat_cluster_to_cache(n, fat, False)
+		self.fat_cache.add(n, fat)
 		return fat
 
 	def _write_fat_cluster(self, n, fat):
-		self._add_fat_cluster_to_cache(n, fat, True)
+		self.fat_cache.add(n, fat, True)
 
 	def flush_fat_cache(self):
 		if self.fat_cache == None:
 			return
-		for (n, v) in self.fat_cache.items():
-			[fat, dirty] = v
-			if dirty:
-				self.write_cluster(n, pack_fat(fat))
-				v[1] = False
-
-	def _add_alloc_cluster_to_cache(self, n, buf, dirty):
-		old = self.alloc_cluster_cache.add(n, [buf, dirty])
-		if old != None:
-			(n, [buf, dirty]) = old
-			if dirty:
-				n += self.allocatable_cluster_offset
-				self.write_cluster(n, buf)
+		self._write_dirty_clusters(self._dirty_fat_clusters())
+
+	def _write_back_alloc_cluster(self, n, buf):
+		n += self.allocatable_cluster_offset
+		if self.journal_name != None:
+			# hold on to it until it can be journaled
+			self.journal_pending[n] = buf
+			return
+		self.write_cluster(n, buf)
 
 	def read_allocatable_cluster(self, n):
-		a = self.alloc_cluster_cache.get(n)
-		if a != None:
+		buf = self.alloc_cluster_cache.get(n)
+		if buf != None:
 			# print "@@@ cache hit", n
-			return a[0]
+			return buf
 		# print "@@@ cache miss", n
 		buf = self.read_cluster(n + self.allocatable_cluster_offset)
-		self._add_alloc_cluster_to_cache(n, buf, False)
+		self.alloc_cluster_cache.add(n, buf)
 		return buf
 
 	def write_allocatable_cluster(self, n, buf):
-		self._add_alloc_cluster_to_cache(n, buf, True)
+		self.alloc_cluster_cache.add(n, buf, True)
 
 	def flush_alloc_cluster_cache(self):
 		if self.alloc_cluster_cache == None:
 			return
-		for (n, a) in self.alloc_cluster_cache.items():
-			[buf, dirty] = a
-			if dirty:
-				n += self.allocatable_cluster_offset
-				self.write_cluster(n, buf)
-				a[1] = False
+		self._write_dirty_clusters(self._dirty_alloc_clusters())
+
+	def flush_caches(self):
+		"""Write all dirty clusters in both caches to the image.
+
+		If a journal is being used, the clusters are written to
+		the journal first and True is returned."""
+
+		if self.fat_cache == None:
+			return False
+		clusters = (self._dirty_alloc_clusters()
+			    + self._dirty_fat_clusters())
+		pending = self.journal_pending
+		if pending:
+			# clusters still in the caches are newer
+			pending.update(clusters)
+			clusters = list(pending.items())
+			self.journal_pending = {}
+		journaled = self.journal_name != None and clusters != []
+		if journaled:
+			self._write_journal(clusters)
+		self._write_dirty_clusters(clusters)
+		return journaled
+
+	def cache_stats(self):
+		"""Return the statistics of the FAT and allocatable
+		cluster caches."""
+
+		return {"fat": self.fat_cache.stats(),
+			"alloc": self.alloc_cluster_cache.stats()}
 
 	def read_fat_cluster(self, n):
 		indirect_offset = n % self.entries_per_cluster
@@ -947,48 +1447,118 @@ class ps2mc:
 		cluster = indirect_fat[indirect_offset]
 		return (self._read_fat_cluster(cluster), cluster)
 
-	def read_fat(self, n):
+	def _load_fat(self):
+		"""Read the entire FAT into memory.
+
+		Also builds a map of the unallocated clusters, with one
+		byte per cluster, and counts them."""
+
+		epc = self.entries_per_cluster
+		limit = max(self.allocatable_cluster_end,
+			    self.allocatable_cluster_limit)
+		table = array.array('I')
+		clusters = []
+		for i in range(div_round_up(limit, epc)):
+			(fat, cluster) = self.read_fat_cluster(i)
+			table.extend(fat)
+			clusters.append(cluster)
+		self._set_fat_table(table, clusters)
+
+	def _set_fat_table(self, table, clusters):
+		self.fat_table = table
+		self.fat_table_clusters = clusters
+		self.fat_table_dirty = set()
+		self.free_clusters = bytearray(pack_fat(table)[3::4]
+					       .translate(_fat_free_trans))
+		self.free_count = self.free_clusters.count(
+			1, 0, self.allocatable_cluster_end)
+
+	def _write_fat_table(self):
+		"""Copy the modified parts of the FAT to the FAT cache."""
+
+		if self.fat_table == None:
+			return
+		epc = self.entries_per_cluster
+		table = self.fat_table
+		for i in sorted(self.fat_table_dirty):
+			self._write_fat_cluster(self.fat_table_clusters[i],
+						table[i * epc : i * epc + epc])
+		self.fat_table_dirty.clear()
+
+	def lookup_fat(self, n):
 		if n < 0 or n >= self.allocatable_cluster_end:
 			raise io_error(EIO,
 				       "FAT cluster index out of range"
 				       " (%d)" % n)
-		offset = n % self.entries_per_cluster
-		fat_cluster = n // self.entries_per_cluster
-		(fat, cluster) = self.read_fat_cluster(fat_cluster)
-		return (fat, offset, cluster)
-
-	def lookup_fat(self, n):
-		(fat, offset, cluster) = self.read_fat(n)
-		return fat[offset]
+		return self.fat_table[n]
 
 	def set_fat(self, n, value):
-		(fat, offset, cluster) = self.read_fat(n)
-		fat[offset] = value
-		self._write_fat_cluster(cluster, fat)
+		if n < 0 or n >= self.allocatable_cluster_end:
+			raise io_error(EIO,
+				       "FAT cluster index out of range"
+				       " (%d)" % n)
+		self.fat_table[n] = value
+		self.fat_table_dirty.add(n // self.entries_per_cluster)
+		free = int((value & PS2MC_FAT_ALLOCATED_BIT) == 0)
+		if self.free_clusters[n] != free:
+			self.free_clusters[n] = free
+			if free:
+				self.free_count += 1
+				cursor = n // self.entries_per_cluster
+				if cursor < self.fat_cursor:
+					self.fat_cursor = cursor
+			else:
+				self.free_count -= 1
 
 	def allocate_cluster(self):
 		epc = self.entries_per_cluster
 		allocatable_cluster_limit = self.allocatable_cluster_limit
 
-		end = div_round_up(allocatable_cluster_limit, epc)
-		remainder = allocatable_cluster_limit % epc
+		n = self.free_clusters.find(1, self.fat_cursor * epc,
+					    allocatable_cluster_limit)
+		if n == -1:
+			self.fat_cursor = div_round_up(allocatable_cluster_limit,
+						       epc)
+			return None
+		self.fat_cursor = n // epc
+		self.set_fat(n, PS2MC_FAT_CHAIN_END)
+		# print "@@@ allocated", n
+		return n
 
-		while self.fat_cursor < end:
-			(fat, cluster) = self.read_fat_cluster(self.fat_cursor)
-			if (self.fat_cursor == end - 1
-			    and remainder != 0):
-				n = min(fat[:remainder])
-			else:
-				n = min(fat)
-			if (n & PS2MC_FAT_ALLOCATED_BIT) == 0:
-				offset = fat.index(n)
-				fat[offset] = PS2MC_FAT_CHAIN_END
-				self._write_fat_cluster(cluster, fat)
-				ret = self.fat_cursor * epc + offset
-				# print "@@@ allocated", ret
-				return ret
-			self.fat_cursor += 1
-		return None
+	def allocate_clusters(self, count):
+		"""Allocate a chain of count clusters.
+
+		The first run of free clusters long enough is used,
+		otherwise the first free clusters found are used.  Returns
+		a list of the clusters, already linked together in the FAT,
+		or None if there aren't enough free clusters."""
+
+		if count <= 0:
+			return []
+		epc = self.entries_per_cluster
+		limit = self.allocatable_cluster_limit
+		free_clusters = self.free_clusters
+		start = self.fat_cursor * epc
+
+		n = free_clusters.find(b"\1" * count, start, limit)
+		if n != -1:
+			clusters = list(range(n, n + count))
+		else:
+			clusters = []
+			n = start
+			while len(clusters) < count:
+				n = free_clusters.find(1, n, limit)
+				if n == -1:
+					return None
+				clusters.append(n)
+				n += 1
+			self.fat_cursor = n // epc
+
+		for i in range(count - 1):
+			self.set_fat(clusters[i],
+				     clusters[i + 1] | PS2MC_FAT_ALLOCATED_BIT)
+		self.set_fat(clusters[-1], PS2MC_FAT_CHAIN_END)
+		return clusters
 
 	def fat_chain(self, first_cluster):
 		return fat_chain(self.lookup_fat, first_cluster)
@@ -1111,7 +1681,7 @@ class ps2mc:
 		if notify:
 			for f in files:
 				if f != thisf:
-					f.update_notfiy(ent[4], ent[2])
+					f.update_notify(ent[4], ent[2])
 		if opened == None:
 			dir.close()
 
@@ -1143,22 +1713,41 @@ class ps2mc:
 				dir.close()
 			del self.open_files[dirloc]
 
+	def dir_index(self, dir):
+		"""Get the name index of a directory, creating it if needed."""
+
+		first_cluster = dir.f.first_cluster
+		index = self.dir_indexes.get(first_cluster)
+		if index == None:
+			index = dir_name_index(dir)
+			self.dir_indexes[first_cluster] = index
+		return index
+
+	def dirent_written(self, first_cluster, i, ent):
+		"""Update the cached directory information after an entry
+		was written."""
+
+		self.path_cache.clear()
+		index = self.dir_indexes.get(first_cluster)
+		if index == None:
+			return
+		if not index.remove(i):
+			del self.dir_indexes[first_cluster]
+			return
+		if ent[0] & DF_EXISTS:
+			index.add(i, ent[8])
+
 	def search_directory(self, dir, name):
 		"""Search dir for name."""
 
-		# start the search where the last search ended.
-		start = dir.tell() - 1
-		if start == -1:
-			start = 0
-		for i in list(range(start, len(dir))) + list(range(0, start)):
-			try:
-				ent = dir[i]
-			except IndexError:
-				raise corrupt("Corrupt directory", dir.f)
-
-			if ent[8] == name and (ent[0] & DF_EXISTS):
-				return (i, ent)
-		return (None, None)
+		i = self.dir_index(dir).find(name)
+		if i == None:
+			return (None, None)
+		try:
+			ent = dir[i]
+		except IndexError:
+			raise corrupt("Corrupt directory", dir.f)
+		return (i, ent)
 
 	def create_dir_entry(self, parent_dirloc, name, mode):
 		"""Create a new directory entry in a directory."""
@@ -1173,12 +1762,8 @@ class ps2mc:
 		l = len(dir)
 		# print "@@@ len", l
 		assert l >= 2
-		for i in range(l):
-			ent = dir[i]
-			if (ent[0] & DF_EXISTS) == 0:
-				break
-		else:
-			i = l
+		i = self.dir_index(dir).free_slot(l)
+		ent = [None] * 9
 
 		dirloc = (dir_ent[4], i)
 		# print "@@@ dirloc", dirloc
@@ -1186,6 +1771,7 @@ class ps2mc:
 		if mode & DF_DIR:
 			mode &= ~DF_FILE
 			cluster = self.allocate_cluster()
+			self.dir_indexes.pop(cluster, None)
 			length = 1
 		else:
 			mode |= DF_FILE
@@ -1250,6 +1836,8 @@ class ps2mc:
 			ent[6] = tod_now()
 		else:
 			ent[0] &= ~DF_EXISTS
+			if ent[0] & DF_DIR:
+				self.dir_indexes.pop(cluster, None)
 		self.update_dirent_all(dirloc, None, ent)
 
 		while cluster != PS2MC_FAT_CHAIN_END:
@@ -1283,6 +1871,22 @@ class ps2mc:
 		if pathname == b"":
 			return (None, None, False)
 
+		# The results are cached until a directory entry is written.
+		# The entry is copied because callers are free to modify it.
+		if pathname.startswith(b"/"):
+			key = (pathname, None)
+		else:
+			key = (pathname, self.curdir)
+		r = self.path_cache.get(key)
+		if r == None:
+			r = self._path_search(pathname)
+			if len(self.path_cache) >= PS2MC_PATH_CACHE_SIZE:
+				self.path_cache.clear()
+			self.path_cache[key] = r
+		(dirloc, ent, is_dir) = r
+		return (dirloc, list(ent), is_dir)
+
+	def _path_search(self, pathname):
 		(components, relative, is_dir) = pathname_split(pathname)
 
 		dirloc = (0, 0)
@@ -1397,8 +2001,8 @@ class ps2mc:
 		dir = self._directory(dirloc, ent[4], ent[2], "rb",
 				      filename)
 		try:
-			for i in range(2, len(dir)):
-				if dir[i][0] & DF_EXISTS:
+			for i in self.dir_index(dir).slots:
+				if i >= 2:
 					return False
 		finally:
 			dir.close()
@@ -1559,17 +2163,14 @@ class ps2mc:
 			newdir.close()
 
 
-	def import_save_file(self, sf, ignore_existing, dirname = None):
-		"""Copy the contents a ps2_save_file object to a directory.
+	def _import_files(self, dir_ent, files, ignore_existing, dirname):
+		"""Create a save directory and copy files into it.
 
-		If ingore_existing is true and the directory being imported
-		to already exists then False is returned instead of raising
-		an error.  If dirname is given then the save file is copied
-		to that directory instead of the directory specified by
-		the save file.
-		"""
+		files is an iterable of (ent, copy) pairs, where calling
+		copy with a ps2mc_file object writes the file's contents
+		to it.  If anything goes wrong the files copied so far and
+		the directory are removed."""
 
-		dir_ent = sf.get_directory()
 		if dirname == None:
 			dirname = b"/" + dir_ent[8]
 
@@ -1585,11 +2186,12 @@ class ps2mc:
 
 		(dir_dirloc, ent) = self.create_dir_entry(root_dirloc,
 							  name, mode)
+		file_ents = []
 		try:
 			assert dirname != b"/"
 			dirname = dirname + b"/"
-			for i in range(dir_ent[2]):
-				(ent, data) = sf.get_file(i)
+			for (ent, copy) in files:
+				file_ents.append(ent)
 				mode = DF_FILE | (ent[0] & ~DF_DIR)
 				(dirloc, ent) \
 					= self.create_dir_entry(dir_dirloc,
@@ -1598,15 +2200,14 @@ class ps2mc:
 				f = self.file(dirloc, ent[4], ent[2], "wb",
 					      dirname + ent[8])
 				try:
-					f.write(data)
+					copy(f)
 				finally:
 					f.close()
-		except EnvironmentError:
+		except (EnvironmentError, ps2save.error):
 			type, what, where = sys.exc_info()
 			try:
 				try:
-					for i in range(dir_ent[2]):
-						(ent, data) = sf.get_file(i)
+					for ent in file_ents:
 						# print "@@@ remove", ent[8]
 						self.remove(dirname + ent[8])
 				except EnvironmentError as why:
@@ -1627,8 +2228,8 @@ class ps2mc:
 
 		dir = self._opendir_dirloc(dir_dirloc, "r+b")
 		try:
-			for i in range(dir_ent[2]):
-				dir[i + 2] = sf.get_file(i)[0]
+			for (i, ent) in enumerate(file_ents):
+				dir[i + 2] = ent
 		finally:
 			dir.close()
 
@@ -1643,7 +2244,62 @@ class ps2mc:
 		self.flush()
 		return True
 
-	def export_save_file(self, filename):
+	def import_save_file(self, sf, ignore_existing, dirname = None):
+		"""Copy the contents a ps2_save_file object to a directory.
+
+		If ingore_existing is true and the directory being imported
+		to already exists then False is returned instead of raising
+		an error.  If dirname is given then the save file is copied
+		to that directory instead of the directory specified by
+		the save file.
+		"""
+
+		def files():
+			for i in range(sf.get_directory()[2]):
+				(ent, data) = sf.get_file(i)
+				def copy(f):
+					f.reserve(len(data))
+					f.write(data)
+				yield (ent, copy)
+
+		return self._import_files(sf.get_directory(), files(),
+					  ignore_existing, dirname)
+
+	def import_save_file_ems(self, f, ignore_existing, dirname = None):
+		"""Copy an EMS (.psu) save file to a directory.
+
+		Like import_save_file, except the save is read from the
+		file f as it's copied, PS2MC_IMPORT_CHUNK_SIZE bytes at a
+		time, instead of being loaded into memory first."""
+
+		def files(count):
+			for i in range(count):
+				ent = ps2save.read_ems_file_ent(f)
+				length = ent[2]
+				def copy(mcf):
+					mcf.reserve(length)
+					remaining = length
+					while remaining > 0:
+						n = min(remaining,
+							PS2MC_IMPORT_CHUNK_SIZE)
+						s = f.read(n)
+						if len(s) != n:
+							raise ps2save.eof(f)
+						mcf.write(s)
+						remaining -= n
+				yield (ent, copy)
+				ps2save.skip_ems_padding(f, length)
+
+		dir_ent = ps2save.read_ems_header(f)
+		return self._import_files(dir_ent, files(dir_ent[2]),
+					  ignore_existing, dirname)
+
+	def _export_save_dir(self, filename):
+		"""Find the files in a save directory to export.
+
+		Returns the directory's entry, and a list of the index
+		and entry of each file in it."""
+
 		(dir_dirloc, dirent, is_dir) = self.path_search(filename)
 		if dir_dirloc == None:
 			raise path_not_found(filename)
@@ -1654,9 +2310,7 @@ class ps2mc:
 		if dir_dirloc == (0, 0):
 			raise io_error(EACCES, "can't export root directory",
 				       filename)
-		sf = ps2save.ps2_save_file()
 		files = []
-		f = None
 		dir = self._directory(dir_dirloc, dirent[4], dirent[2],
 				      "rb", filename)
 		try:
@@ -1667,6 +2321,17 @@ class ps2mc:
 					       " ingored."
 					       % (dirent[8], ent[8])))
 					continue
+				files.append((i, ent))
+		finally:
+			dir.close()
+		return (dirent, files)
+
+	def export_save_file(self, filename):
+		(dirent, file_ents) = self._export_save_dir(filename)
+		files = []
+		f = None
+		try:
+			for (i, ent) in file_ents:
 				f = self.file((dirent[4], i), ent[4], ent[2],
 					      "rb")
 				data = f.read(ent[2])
@@ -1676,13 +2341,51 @@ class ps2mc:
 		finally:
 			if f != None:
 				f.close()
-			dir.close()
+		sf = ps2save.ps2_save_file()
 		dirent[2] = len(files)
 		sf.set_directory(dirent)
 		for (i, (ent, data)) in enumerate(files):
 			sf.set_file(i, ent, data)
 		return sf
 
+	def export_save_file_ems(self, filename, f):
+		"""Write a save directory to f as an EMS (.psu) save file.
+
+		Each file is copied to f a cluster at a time as its
+		chain is followed, rather than being read into memory."""
+
+		(dirent, files) = self._export_save_dir(filename)
+		cluster_size = self.cluster_size
+		dirent[2] = len(files)
+		f.write(ps2save.pack_ems_header(dirent))
+		for (i, ent) in files:
+			f.write(pack_dirent(ent))
+			cluster = ent[4]
+			remaining = ent[2]
+			while remaining > 0:
+				if cluster == PS2MC_FAT_CHAIN_END:
+					raise io_error(EIO, "chain ends before"
+						       " end of file", filename)
+				buf = self.read_allocatable_cluster(cluster)
+				if remaining < cluster_size:
+					buf = buf[:remaining]
+				f.write(buf)
+				remaining -= len(buf)
+				next = self.lookup_fat(cluster)
+				if (next == PS2MC_FAT_CHAIN_END
+				    or (next & PS2MC_FAT_ALLOCATED_BIT) == 0):
+					# an unallocated entry ends the
+					# chain, as in _check_file()
+					cluster = PS2MC_FAT_CHAIN_END
+				else:
+					cluster = next & ~PS2MC_FAT_ALLOCATED_BIT
+			# EMS files are padded to a fixed block size, not
+			# the memory card's cluster size
+			f.write(b"\0" * (round_up(ent[2],
+						  ps2save.PS2SAVE_EMS_BLOCK_SIZE)
+					 - ent[2]))
+		f.flush()
+
 	def _remove_dir(self, dirloc, ent, dirname):
 		"""Recurse over a directory tree to remove it.
 		If not "", dirname must end with a slash (/)."""
@@ -1728,112 +2431,179 @@ class ps2mc:
 
 	def get_free_space(self):
 		"""Returns the amount of free space in bytes."""
-
-		free = 0
-		for i in range(self.allocatable_cluster_end):
-			if (self.lookup_fat(i) & PS2MC_FAT_ALLOCATED_BIT) == 0:
-				free += 1
-		return free * self.cluster_size
+		return self.free_count * self.cluster_size
 
 	def get_allocatable_space(self):
 		"""Returns the total amount of allocatable space in bytes."""
 		return self.allocatable_cluster_limit * self.cluster_size
 
-	def _check_file(self, fat, first_cluster, length):
+	def _check_file(self, report, fat, used, first_cluster, length):
+		"""Follow a file's chain of clusters, marking them as used.
+
+		Returns the reason the chain is bad, or None, along with
+		the number of good clusters at the start of the chain."""
+
 		cluster = first_cluster
+		fat_len = len(fat)
 		i = 0
 		while cluster != PS2MC_FAT_CHAIN_END:
-			if cluster < 0 or cluster >= len(fat):
-				return "invalid cluster in chain"
-			if fat[cluster]:
-				return "cross linked chain"
+			if cluster < 0 or cluster >= fat_len:
+				return ("invalid cluster in chain", i)
+			if used[cluster]:
+				report.cross_linked.append(cluster)
+				return ("cross linked chain", i)
 			i += 1
 			# print cluster,
-			fat[cluster] = 1
-			next = self.lookup_fat(cluster)
+			used[cluster] = 1
+			next = fat[cluster]
 			if next == PS2MC_FAT_CHAIN_END:
 				break
 			if (next & PS2MC_FAT_ALLOCATED_BIT) == 0:
-				return "unallocated cluster in chain"
+				return ("unallocated cluster in chain", i)
 			cluster = next & ~PS2MC_FAT_ALLOCATED_BIT
 		file_cluster_end = div_round_up(length, self.cluster_size)
 		if i < file_cluster_end:
-			return "chain ends before end of file"
+			return ("chain ends before end of file", i)
 		elif i > file_cluster_end:
-			return "chain continues after end of file"
-		return None
+			return ("chain continues after end of file", i)
+		return (None, i)
 
-	def _check_dir(self, fat, dirloc, dirname, ent):
-		why = self._check_file(fat, ent[4],
-				       ent[2] * PS2MC_DIRENT_LENGTH)
-		if why != None:
-			print("bad directory:", dirname.decode() + ":", why)
-			return False
-		ret = True
+	def _repair_chain(self, fat, used, ent, good):
+		"""Truncate a bad chain after its good clusters.
+
+		The length in the directory entry ent is reduced to fit
+		the chain that's left, or if nothing is left of a
+		directory the entry is removed.  Clusters cut off the end
+		of the chain are marked unused so they'll be freed as
+		lost clusters."""
+
+		cluster_size = self.cluster_size
+		is_dir = ent[0] & DF_DIR
+		length = ent[2]
+		if is_dir:
+			length *= PS2MC_DIRENT_LENGTH
+		keep = min(good, div_round_up(length, cluster_size))
+
+		chain = []
+		cluster = ent[4]
+		for i in range(good):
+			chain.append(cluster)
+			cluster = fat[cluster] & ~PS2MC_FAT_ALLOCATED_BIT
+		for cluster in chain[keep:]:
+			used[cluster] = 0
+
+		length = min(length, keep * cluster_size)
+		if is_dir:
+			self.dir_indexes.pop(ent[4], None)
+			length //= PS2MC_DIRENT_LENGTH
+			if length < 2:
+				# not even room for "." and ".."
+				for cluster in chain[:keep]:
+					used[cluster] = 0
+				ent[0] &= ~DF_EXISTS
+				return
+		if keep == 0:
+			ent[4] = PS2MC_FAT_CHAIN_END
+		else:
+			self.set_fat(chain[keep - 1], PS2MC_FAT_CHAIN_END)
+		ent[2] = length
+
+	def _check_dir(self, report, fat, used, dirloc, dirname, ent,
+		       repair):
 		first_cluster = ent[4]
 		length = ent[2]
+		mode = "rb"
+		if repair:
+			mode = "r+b"
 		dir = self._directory(dirloc, first_cluster, length,
-				      "rb", dirname)
+				      mode, dirname)
 		dot_ent = dir[0]
 		if dot_ent[8] != b".":
-			print("bad directory:", dirname.decode() + ': missing "." entry')
-			ret = False
+			report.add_error("directory", dirname,
+					 'missing "." entry', dirloc)
 		if (dot_ent[4], dot_ent[5]) != dirloc:
-			print("bad directory:", dirname.decode() + ': bad "." entry')
-			ret = False
+			report.add_error("directory", dirname,
+					 'bad "." entry', dirloc)
+			if repair and dot_ent[8] == b".":
+				(dot_ent[4], dot_ent[5]) = dirloc
+				dir.write_raw_ent(0, dot_ent, False)
 		if dir[1][8] != b"..":
-			print("bad directory:", (dirname.decode()
-						 + ': missing ".." entry'))
-			ret = False
+			report.add_error("directory", dirname,
+					 'missing ".." entry', dirloc)
 		for i in range(2, length):
 			ent = dir[i]
 			mode = ent[0]
 			if not (mode & DF_EXISTS):
 				continue
 			if mode & DF_DIR:
-				if not self._check_dir(fat, (first_cluster, i),
-						       dirname + ent[8] + b"/",
-						       ent):
-					ret = False
+				kind = "directory"
+				pathname = dirname + ent[8] + b"/"
+				chain_length = ent[2] * PS2MC_DIRENT_LENGTH
 			else:
-				why = self._check_file(fat, ent[4], ent[2])
-				if why != None:
-					print("bad file:", (dirname.decode() + ent[8].decode()
-							    + ":"), why)
-					ret = False
+				kind = "file"
+				pathname = dirname + ent[8]
+				chain_length = ent[2]
+			(why, good) = self._check_file(report, fat, used,
+						       ent[4], chain_length)
+			if why != None:
+				report.add_error(kind, pathname, why,
+						 (first_cluster, i))
+				if not repair:
+					continue
+				self._repair_chain(fat, used, ent, good)
+				dir.write_raw_ent(i, ent, False)
+			if (ent[0] & (DF_DIR | DF_EXISTS)
+			    == (DF_DIR | DF_EXISTS)):
+				self._check_dir(report, fat, used,
+						(first_cluster, i),
+						pathname, ent, repair)
 
 		dir.close()
-		return ret
 
-	def check(self):
+	def check(self, repair = False):
 		"""Run a simple file system check.
 
-		Any problems found are reported to stdout."""
-
-		ret = True
+		Returns a check_report object describing any problems
+		found, which is true if there were none.  If repair is
+		true, bad chains are truncated, bad "." entries are
+		fixed and lost clusters are freed."""
 
-		fat_len = int(str(self.allocatable_cluster_end))
-		if not isinstance(fat_len, int):
-			raise error("Memory card image too big to check.")
+		report = check_report()
 
-		fat = array.array('B', [0]) * fat_len
+		# take a snapshot of the FAT, and keep track of which
+		# clusters are used by a file or directory.
+		fat = self.fat_table[:self.allocatable_cluster_end]
+		fat_len = len(fat)
+		used = bytearray(fat_len)
 
 		cluster = self.read_allocatable_cluster(0)
 		ent = unpack_dirent(cluster[:PS2MC_DIRENT_LENGTH])
-		ret = self._check_dir(fat, (0, 0), b"/", ent)
-
-		lost_clusters = 0
-		for i in range(self.allocatable_cluster_end):
-			a = self.lookup_fat(i)
-			if (a & PS2MC_FAT_ALLOCATED_BIT) and not fat[i]:
-				print(i, end=' ')
-				lost_clusters += 1
-		if lost_clusters > 0:
-			print()
-			print("found", lost_clusters, "lost clusters")
-			ret = False
-
-		return ret
+		(why, good) = self._check_file(report, fat, used, ent[4],
+					       ent[2] * PS2MC_DIRENT_LENGTH)
+		if why != None:
+			# the root directory can't be repaired
+			report.add_error("directory", b"/", why, (0, 0))
+		else:
+			self._check_dir(report, fat, used, (0, 0), b"/", ent,
+					repair)
+
+		# lost clusters are allocated but not used
+		free = pack_fat(fat)[3::4].translate(_fat_free_trans)
+		lost = (int.from_bytes(b"\1" * fat_len, "big")
+			& ~(int.from_bytes(free, "big")
+			    | int.from_bytes(used, "big")))
+		if lost != 0:
+			lost = lost.to_bytes(fat_len, "big")
+			i = lost.find(1)
+			while i != -1:
+				report.lost_clusters.append(i)
+				i = lost.find(1, i + 1)
+
+		if repair:
+			for i in report.lost_clusters:
+				self.set_fat(i, PS2MC_FAT_CLUSTER_MASK)
+
+		return report
 
 	def _globdir(self, dirname, components, is_dir):
 		pattern = components[0]
@@ -1934,12 +2704,38 @@ class ps2mc:
 			dir.close()
 		return length
 
+	def transaction(self):
+		"""Return a context manager that defers flushing.
+
+		Inside a "with mc.transaction():" block the flushes that
+		operations normally do are skipped, and the image is
+		flushed once when the outermost block ends.  When a
+		journal is being used, dirty clusters evicted from the
+		caches are kept in memory until they're journaled, so
+		the image is also flushed whenever more of them pile up
+		than both caches hold."""
+
+		return _transaction(self)
+
 	def flush(self):
-		self.flush_alloc_cluster_cache()
-		self.flush_fat_cache()
+		if (self.transaction_level > 0
+		    and len(self.journal_pending)
+			<= self.fat_cache.length
+			   + self.alloc_cluster_cache.length):
+			return
+		for (dir, files) in list(self.open_files.values()):
+			for f in list(files):
+				f.flush()
+		journaled = self.flush_caches()
 		if self.modified:
 			self.write_superblock()
+		if self.image_map != None:
+			self.image_map.flush()
 		self.f.flush()
+		if journaled:
+			os.fsync(self.f.fileno())
+			os.remove(self.journal_name)
+			self._sync_journal_dir(self.journal_name)
 
 	def close(self):
 		"""Close all open files.
@@ -1971,10 +2767,17 @@ class ps2mc:
 			if self.rootdir != None:
 				self.rootdir.close()
 			if self.fat_cache != None:
+				self.transaction_level = 0
 				self.flush()
 		finally:
 			self.open_files = None
+			self.dir_indexes = None
+			self.path_cache = None
 			self.fat_cache = None
+			self.alloc_cluster_cache = None
+			if self.image_map != None:
+				self.image_map.close()
+				self.image_map = None
 			self.f = None
 			self.rootdir = None
 
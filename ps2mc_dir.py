@@ -59,6 +59,9 @@ if hasattr(struct, "Struct"):
 	def unpack_tod(s):
 		return _tod_struct.unpack(s)
 
+	def pack_tod(tod):
+		return _tod_struct.pack(*tod)
+
 	def unpack_dirent(s):
 		ent = _dirent_struct.unpack(s)
 		ent = list(ent)
@@ -76,6 +79,9 @@ else:
 	def unpack_tod(s):
 		return struct.unpack(_tod_fmt, s)
 
+	def pack_tod(tod):
+		return struct.pack(_tod_fmt, *tod)
+
 	def unpack_dirent(s):
 		# mode, ???, length, created,
 		# fat_cluster, parent_entry, modified, attr,
@@ -24,7 +24,8 @@ except ImportError:
 
 __ALL__ = ["ECC_CHECK_OK", "ECC_CHECK_CORRECTED", "ECC_CHECK_FAILED",
 	   "ecc_calculate", "ecc_check",
-	   "ecc_calculate_page", "ecc_check_page"]
+	   "ecc_calculate_page", "ecc_check_page",
+	   "ecc_calculate_codes", "ecc_encode_pages", "ecc_check_pages"]
 
 ECC_CHECK_OK = 0
 ECC_CHECK_CORRECTED = 1
@@ -59,6 +60,77 @@ def _make_ecc_tables():
 
 _parity_table, _column_parity_masks = _make_ecc_tables()
 
+#
+# Tables used to calculate the Hamming codes of many 128 byte chunks at
+# once.  Both the column parity and the line parity are linear, so the
+# codes of a chunk can be derived from the XOR of all its bytes and the
+# XOR of the indices of all its odd parity bytes.  The XORs are done
+# for every chunk in a buffer at once by folding a big integer.
+#
+
+def _make_batch_ecc_tables():
+	odd_parity = bytes([0xFF * p for p in _parity_table])
+	column = bytes([0x77 ^ m for m in _column_parity_masks])
+	# Bit 7 of the folded index is the parity of the number of
+	# odd parity bytes in the chunk.
+	line_0 = bytes([0x7F ^ (v & 0x7F) ^ (0x7F * (v >> 7))
+			for v in range(256)])
+	line_1 = bytes([0x7F ^ (v & 0x7F) for v in range(256)])
+	return odd_parity, column, line_0, line_1
+
+(_odd_parity_trans, _column_parity_trans,
+ _line_parity_0_trans, _line_parity_1_trans) = _make_batch_ecc_tables()
+
+_fold_masks_cache = {}
+
+def _fold_masks(chunks):
+	"""Return the masks and index pattern used for a number of chunks."""
+
+	r = _fold_masks_cache.get(chunks)
+	if r == None:
+		masks = []
+		bits = 512
+		while bits >= 8:
+			m = (b"\xFF" * (bits // 8)
+			     + b"\0" * (128 - bits // 8)) * chunks
+			masks.append((bits, int.from_bytes(m, "little")))
+			bits //= 2
+		index = bytes([0x80 | i for i in range(128)]) * chunks
+		r = (masks, int.from_bytes(index, "little"))
+		_fold_masks_cache[chunks] = r
+	return r
+
+def _xor_fold(x, chunks, masks):
+	"""XOR together the bytes of each 128 byte chunk of an integer.
+
+	Returns a string with one byte for each chunk."""
+
+	for (bits, mask) in masks:
+		x = (x ^ (x >> bits)) & mask
+	return x.to_bytes(chunks * 128, "little")[::128]
+
+def ecc_calculate_codes(s):
+	"""Calculate the Hamming codes for every 128 byte chunk of s.
+
+	Returns a string of three bytes for each chunk, in the same order
+	as they're stored in the spare area of a page."""
+
+	s = bytes(s)
+	chunks = div_round_up(len(s), 128)
+	if chunks == 0:
+		return b""
+	# zero bytes don't change the codes
+	s += b"\0" * (chunks * 128 - len(s))
+	(masks, index) = _fold_masks(chunks)
+	column = _xor_fold(int.from_bytes(s, "little"), chunks, masks)
+	odd = int.from_bytes(s.translate(_odd_parity_trans), "little")
+	line = _xor_fold(odd & index, chunks, masks)
+	codes = bytearray(chunks * 3)
+	codes[0::3] = column.translate(_column_parity_trans)
+	codes[1::3] = line.translate(_line_parity_0_trans)
+	codes[2::3] = line.translate(_line_parity_1_trans)
+	return bytes(codes)
+
 def _ecc_calculate(s):
 	"""Calculate the Hamming code for a 128 byte long string or byte array."""
 
@@ -124,14 +196,16 @@ def _ecc_check(s, ecc):
 
 def ecc_calculate_page(page):
 	"""Return a list of the ECC codes for a PS2 memory card page."""
-	return [ecc_calculate(page[i * 128 : i * 128 + 128])
-		for i in range(div_round_up(len(page), 128))]
+	codes = ecc_calculate_codes(page)
+	return [list(codes[i : i + 3])
+		for i in range(0, len(codes), 3)]
 
 def ecc_check_page(page, spare):
 	"""Check and correct any single bit errors in a PS2 memory card page."""
 
-	failed = False
-	corrected = False
+	codes = ecc_calculate_codes(page)
+	if codes == spare[:len(codes)]:
+		return (ECC_CHECK_OK, page, spare)
 
 	#chunks = [(array.array('B', page[i * 128 : i * 128 + 128]),
 	#	   map(ord, spare[i * 3 : i * 3 + 3]))
@@ -150,14 +224,61 @@ def ecc_check_page(page, spare):
 		# rebuild sector and spare from the corrected versions
 		page = b"".join([a[0].tobytes()
 				 for a in chunks])
-		spare = "".join([chr(a[1][i])
-				 for a in chunks
-				 for i in range(3)])
+		spare = bytes([a[1][i]
+			       for a in chunks
+			       for i in range(3)])
 		ret = ECC_CHECK_CORRECTED
 	if ECC_CHECK_FAILED in r:
 		ret = ECC_CHECK_FAILED
 	return (ret, page, spare)
 
+def ecc_encode_pages(buf, page_size, spare_size):
+	"""Add spare areas containing ECC codes to a sequence of pages.
+
+	Returns the raw image data of the pages in buf, each followed by
+	its spare area."""
+
+	pages = len(buf) // page_size
+	codes = ecc_calculate_codes(buf)
+	clen = len(codes) // pages
+	pad = b"\0" * (spare_size - clen)
+	raw = []
+	for i in range(pages):
+		raw.append(buf[i * page_size : i * page_size + page_size])
+		raw.append(codes[i * clen : i * clen + clen])
+		raw.append(pad)
+	return b"".join(raw)
+
+def ecc_check_pages(raw, page_size, spare_size):
+	"""Check and correct any single bit errors in a sequence of raw pages.
+
+	Returns a tuple of the status and the data of the pages without
+	their spare areas."""
+
+	raw_page_size = page_size + spare_size
+	pages = len(raw) // raw_page_size
+	data = b"".join([raw[i * raw_page_size : i * raw_page_size + page_size]
+			 for i in range(pages)])
+	codes = ecc_calculate_codes(data)
+	clen = len(codes) // pages
+	spares = b"".join([raw[i * raw_page_size + page_size
+			       : i * raw_page_size + page_size + clen]
+			   for i in range(pages)])
+	if codes == spares:
+		return (ECC_CHECK_OK, data)
+
+	ret = ECC_CHECK_OK
+	data = []
+	for i in range(pages):
+		off = i * raw_page_size
+		(status, page, spare) \
+			= ecc_check_page(raw[off : off + page_size],
+					 raw[off + page_size
+					     : off + raw_page_size])
+		ret = max(ret, status)
+		data.append(page)
+	return (ret, b"".join(data))
+
 if mymcsup == None:
 	ecc_calculate = _ecc_calculate
 	ecc_check = _ecc_check
@@ -13,7 +13,6 @@ import sys
 import os
 import struct
 import binascii
-import array
 import zlib
 
 from round import round_up
@@ -65,6 +64,16 @@ PS2SAVE_CBS_RC4S = [0x5f, 0x1f, 0x85, 0x6f, 0x31, 0xaa, 0x3b, 0x18,
 		    0x8a, 0xd9, 0xec, 0x27, 0x44, 0x0e, 0x33, 0xc8,
 		    0x6b, 0x93, 0x32, 0x48, 0xb6, 0x30, 0x43, 0xa5]
 
+# Files in EMS (.psu) save files are padded to a multiple of this,
+# whatever the cluster size of the memory card they came from.
+PS2SAVE_EMS_BLOCK_SIZE = 1024
+
+# The length of the header written to Codebreaker saves.
+PS2SAVE_CBS_HEADER_LENGTH = 0x128
+
+# The RC4 keystream is generated this many bytes at a time.
+PS2SAVE_RC4_CHUNK_SIZE = 65536
+
 class error(Exception):
 	"""Base for all exceptions specific to this module."""
 	pass
@@ -192,20 +201,74 @@ def shift_jis_conv(src, encoding = None):
 
 	return "".join(a).encode(encoding, "replace")
 
+class rc4_keystream:
+	"""Generates the RC4 keystream for the permutation s."""
+
+	def __init__(self, s):
+		self.s = bytearray(s)
+		self.i = 0
+		self.j = 0
+
+	def read(self, n):
+		"""Return the next n bytes of the keystream."""
+
+		s = self.s
+		i = self.i
+		j = self.j
+		out = bytearray(n)
+		for k in range(n):
+			i = (i + 1) & 255
+			si = s[i]
+			j = (j + si) & 255
+			sj = s[j]
+			s[i] = sj
+			s[j] = si
+			out[k] = s[(si + sj) & 255]
+		self.i = i
+		self.j = j
+		return out
+
+def _xor_bytes(a, b):
+	"""XOR two byte strings of the same length together."""
+
+	n = len(a)
+	return (int.from_bytes(a, "little")
+		^ int.from_bytes(b, "little")).to_bytes(n, "little")
+
+# Every Codebreaker save is encrypted with the same keystream, so the
+# start of it is kept and extended as longer saves are seen.
+_cbs_keystream = None
+_cbs_keystream_prefix = bytearray()
+
+def _cbs_keystream_slice(start, end):
+	"""Return bytes start to end of the Codebreaker keystream."""
+
+	global _cbs_keystream
+
+	prefix = _cbs_keystream_prefix
+	if len(prefix) < end:
+		if _cbs_keystream == None:
+			_cbs_keystream = rc4_keystream(PS2SAVE_CBS_RC4S)
+		# extend it in chunks rather than a bit at a time
+		prefix += _cbs_keystream.read(round_up(end - len(prefix),
+						       PS2SAVE_RC4_CHUNK_SIZE))
+	return memoryview(prefix)[start:end]
+
+def cbs_crypt(t, offset = 0):
+	"""Encrypt/decrypt part of the body of a Codebreaker save.
+
+	offset is the position of t in the body."""
+
+	return _xor_bytes(t, _cbs_keystream_slice(offset, offset + len(t)))
+
 def rc4_crypt(s, t):
 	"""RC4 encrypt/decrypt the string t using the permutation s.
 
-	Returns a byte array."""
+	Returns a bytes object."""
 
-	s = array.array('B', s)
-	t = array.array('B', t)
-	j = 0
-	for ii in range(len(t)):
-		i = (ii + 1) % 256
-		j = (j + s[i]) % 256
-		(s[i], s[j]) = (s[j], s[i])
-		t[ii] ^= s[(s[i] + s[j]) % 256]
-	return t
+	if s == PS2SAVE_CBS_RC4S:
+		return cbs_crypt(t)
+	return _xor_bytes(t, rc4_keystream(s).read(len(t)))
 
 # def sps_check(s):
 # 	"""Calculate the checksum for a SharkPort save."""
@@ -259,6 +322,53 @@ def _read_long_string(f):
 	length = struct.unpack("<L", _read_fixed(f, 4))[0]
 	return _read_fixed(f, length)
 
+def read_ems_header(f):
+	"""Read the directory entries at the start of an EMS (.psu) save file.
+
+	Returns the save's directory entry, with the length set to the
+	number of files in the save."""
+
+	dirent = unpack_dirent(_read_fixed(f, PS2MC_DIRENT_LENGTH))
+	dotent = unpack_dirent(_read_fixed(f, PS2MC_DIRENT_LENGTH))
+	dotdotent = unpack_dirent(_read_fixed(f, PS2MC_DIRENT_LENGTH))
+	if (not mode_is_dir(dirent[0])
+	    or not mode_is_dir(dotent[0])
+	    or not mode_is_dir(dotdotent[0])
+	    or dirent[2] < 2):
+		raise corrupt("Not a EMS (.psu) save file.", f)
+	dirent[2] -= 2
+	return dirent
+
+def read_ems_file_ent(f):
+	"""Read the directory entry of the next file in an EMS save file."""
+
+	ent = unpack_dirent(_read_fixed(f, PS2MC_DIRENT_LENGTH))
+	if not mode_is_file(ent[0]):
+		raise subdir(f)
+	return ent
+
+def skip_ems_padding(f, length):
+	"""Skip the padding after a file of the given length in an EMS
+	save file."""
+
+	_read_fixed(f, round_up(length, PS2SAVE_EMS_BLOCK_SIZE) - length)
+
+def pack_ems_header(dirent):
+	"""Return the directory entries that start an EMS (.psu) save file.
+
+	The length in dirent is the number of files in the save, not
+	including the "." and ".." entries."""
+
+	dirent = dirent[:]
+	dirent[2] += 2
+	return (pack_dirent(dirent)
+		+ pack_dirent((DF_RWX | DF_DIR | DF_0400 | DF_EXISTS,
+			       0, 0, dirent[3],
+			       0, 0, dirent[3], 0, b"."))
+		+ pack_dirent((DF_RWX | DF_DIR | DF_0400 | DF_EXISTS,
+			       0, 0, dirent[3],
+			       0, 0, dirent[3], 0, b"..")))
+
 class ps2_save_file:
 	"""The state of a PlayStation 2 save file."""
 
@@ -267,10 +377,12 @@ class ps2_save_file:
 		self.file_data = None
 		self.dirent = None
 		self._defer_load_max = False
+		self._max_reader = None
 
 	def set_directory(self, ent, defer = False):
 		self._defer_load_max = defer
 		self._compressed = None
+		self._max_reader = None
 		self.file_ents = [None] * ent[2]
 		self.file_data = [None] * ent[2]
 		self.dirent = list(ent)
@@ -283,9 +395,8 @@ class ps2_save_file:
 		return self.dirent[:]
 
 	def get_file(self, i):
-		if self._defer_load_max:
-			self._defer_load_max = False
-			self._load_max_drive_2()
+		if self._defer_load_max and self.file_ents[i] == None:
+			self._load_max_drive_2(i % self.dirent[2])
 		return (self.file_ents[i], self.file_data[i])
 
 	def __len__(self):
@@ -304,44 +415,20 @@ class ps2_save_file:
 	def load_ems(self, f):
 		"""Load EMS (.psu) save files."""
 
-		cluster_size = 1024
-
-		dirent = unpack_dirent(_read_fixed(f, PS2MC_DIRENT_LENGTH))
-		dotent = unpack_dirent(_read_fixed(f, PS2MC_DIRENT_LENGTH))
-		dotdotent = unpack_dirent(_read_fixed(f, PS2MC_DIRENT_LENGTH))
-		if (not mode_is_dir(dirent[0])
-		    or not mode_is_dir(dotent[0])
-		    or not mode_is_dir(dotdotent[0])
-		    or dirent[2] < 2):
-			raise corrupt("Not a EMS (.psu) save file.", f)
-
-		dirent[2] -= 2
+		dirent = read_ems_header(f)
 		self.set_directory(dirent)
 
 		for i in range(dirent[2]):
-			ent = unpack_dirent(_read_fixed(f,
-							PS2MC_DIRENT_LENGTH))
-			if not mode_is_file(ent[0]):
-				raise subdir(f)
+			ent = read_ems_file_ent(f)
 			flen = ent[2]
 			self.set_file(i, ent, _read_fixed(f, flen))
-			_read_fixed(f, round_up(flen, cluster_size) - flen)
+			skip_ems_padding(f, flen)
 
 
 	def save_ems(self, f):
-		cluster_size = 1024
-
-		dirent = self.dirent[:]
-		dirent[2] += 2
-		f.write(pack_dirent(dirent))
-		f.write(pack_dirent((DF_RWX | DF_DIR | DF_0400 | DF_EXISTS,
-				     0, 0, dirent[3],
-				     0, 0, dirent[3], 0, b".")))
-		f.write(pack_dirent((DF_RWX | DF_DIR | DF_0400 | DF_EXISTS,
-				     0, 0, dirent[3],
-				     0, 0, dirent[3], 0, b"..")))
-
-		for i in range(dirent[2] - 2):
+		f.write(pack_ems_header(self.dirent))
+
+		for i in range(self.dirent[2]):
 			(ent, data) = self.get_file(i)
 			f.write(pack_dirent(ent))
 			if not mode_is_file(ent[0]):
@@ -349,41 +436,67 @@ class ps2_save_file:
 				# print hex(ent[0])
 				raise error("Directory has a subdirectory.")
 			f.write(data)
-			f.write(b"\0" * (round_up(len(data), cluster_size)
+			f.write(b"\0" * (round_up(len(data),
+						  PS2SAVE_EMS_BLOCK_SIZE)
 					 - len(data)))
 		f.flush()
 
-	def _load_max_drive_2(self):
-		(length, s) = self._compressed
-		self._compressed = None
-
-		if lzari == None:
-			raise error("The lzari module is needed to "
-				    " decompress MAX Drive saves.")
-		s = lzari.decode(s, length,
-				 "decompressing " + self.dirent[8].decode() + ": ")
+	def _load_max_drive_2(self, last):
+		"""Decompress the files of a MAX Drive save up to file last.
+
+		Files are decompressed one at a time as they're asked for
+		and kept in file_data like any other save's files.  The
+		compressed data is kept until the last file has been
+		decompressed."""
+
+		if self._max_reader == None:
+			(length, s) = self._compressed
+			self._compressed = None
+
+			if lzari == None:
+				raise error("The lzari module is needed to "
+					    " decompress MAX Drive saves.")
+			progress = None
+			if self._max_progress:
+				progress = ("decompressing "
+					    + self.dirent[8].decode() + ": ")
+			self._max_reader = lzari.lzari_reader(s, length,
+							      progress)
+			self._max_next = 0
+			self._max_off = 0
+		reader = self._max_reader
 		dirlen = self.dirent[2]
 		timestamp = self.dirent[3]
-		off = 0
-		for i in range(dirlen):
-			if len(s) - off < 36:
-				raise eof(f)
-			(l, name) = struct.unpack("<L32s", s[off : off + 36])
+		off = self._max_off
+		for i in range(self._max_next, last + 1):
+			hdr = reader.read(36)
+			if len(hdr) < 36:
+				raise eof()
+			(l, name) = struct.unpack("<L32s", hdr)
 			name = zero_terminate(name)
 			# print "%08x %08x %s" % (off, l, name)
 			off += 36
-			data = s[off : off + l]
+			data = reader.read(l)
 			if len(data) != l:
-				raise eof(f)
+				raise eof()
 			self.set_file(i,
 				      (DF_RWX | DF_FILE | DF_0400 | DF_EXISTS,
 				       0, l, timestamp, 0, 0, timestamp, 0,
 				       name),
 				      data)
 			off += l
-			off = round_up(off + 8, 16) - 8
+			pad = round_up(off + 8, 16) - 8 - off
+			reader.read(pad)
+			off += pad
+			self._max_next = i + 1
+			self._max_off = off
+		if self._max_next == dirlen:
+			# finish decompressing any trailing padding
+			reader.read()
+			self._max_reader = None
+			self._defer_load_max = False
 
-	def load_max_drive(self, f, timestamp = None):
+	def load_max_drive(self, f, timestamp = None, progress = True):
 		s = f.read(0x5C)
 		magic = None
 		if len(s) == 0x5C:
@@ -405,8 +518,9 @@ class ps2_save_file:
 				    dirname),
 				   True)
 		self._compressed = (length, s)
+		self._max_progress = progress
 
-	def save_max_drive(self, f):
+	def save_max_drive(self, f, progress = True):
 		if lzari == None:
 			raise error("The lzari module is needed to "
 				    " decompress MAX Drive saves.")
@@ -428,7 +542,10 @@ class ps2_save_file:
 			s += data
 			s += b"\0" * (round_up(len(s) + 8, 16) - 8 - len(s))
 		length = len(s)
-		progress =  "compressing " + dirent[8].decode() + ": "
+		if progress:
+			progress = "compressing " + dirent[8].decode() + ": "
+		else:
+			progress = None
 		compressed = lzari.encode(s, progress)
 		hdr = struct.pack("<12sL32s32sLLL", PS2SAVE_MAX_MAGIC,
 				  0, dirent[8], iconsysname,
@@ -471,7 +588,7 @@ class ps2_save_file:
 		clen = len(body)
 		if clen != flen and clen != flen - hlen:
 			raise eof(f)
-		body = rc4_crypt(PS2SAVE_CBS_RC4S, body)
+		body = cbs_crypt(body)
 		dcobj = zlib.decompressobj()
 		body = dcobj.decompress(body, dlen)
 
@@ -505,6 +622,63 @@ class ps2_save_file:
 			self.set_file(i, (mode, 0, size, created, 0, 0,
 					  modified, 0, name), data)
 
+	def save_codebreaker(self, f):
+		"""Save as a Codebreaker (.cbs) save file.
+
+		Each file is compressed and encrypted a chunk at a time
+		as it's written.  f must be seekable, as the length of
+		the compressed body is filled in at the end."""
+
+		dirent = self.dirent
+		hlen = PS2SAVE_CBS_HEADER_LENGTH
+		title = b""
+		icon_sys = self.get_icon_sys()
+		if icon_sys != None:
+			title = icon_sys[14]
+		dlen = 0
+		for i in range(dirent[2]):
+			(ent, data) = self.get_file(i)
+			if not mode_is_file(ent[0]):
+				raise error("Non-file in save file.")
+			dlen += 64 + len(data)
+
+		def header(clen):
+			return struct.pack("<4sLLLL32s8s8sLLLLLL%ds" % (hlen - 92),
+					   PS2SAVE_CBS_MAGIC, 0, hlen,
+					   dlen, hlen + clen, dirent[8],
+					   pack_tod(dirent[3]),
+					   pack_tod(dirent[6]),
+					   0, 0, dirent[0], 0, 0, 0, title)
+
+		start = f.tell()
+		f.write(header(0))
+		cobj = zlib.compressobj()
+		clen = 0
+		for i in range(dirent[2]):
+			(ent, data) = self.get_file(i)
+			chunks = [struct.pack("<8s8sLHHLL32s",
+					      pack_tod(ent[3]),
+					      pack_tod(ent[6]),
+					      len(data), ent[0], 0, 0, 0,
+					      ent[8])]
+			data = memoryview(data)
+			for off in range(0, len(data), PS2SAVE_RC4_CHUNK_SIZE):
+				chunks.append(data[off : off
+						   + PS2SAVE_RC4_CHUNK_SIZE])
+			for chunk in chunks:
+				s = cobj.compress(chunk)
+				f.write(cbs_crypt(s, clen))
+				clen += len(s)
+		s = cobj.flush()
+		f.write(cbs_crypt(s, clen))
+		clen += len(s)
+
+		end = f.tell()
+		f.seek(start)
+		f.write(header(clen))
+		f.seek(end)
+		f.flush()
+
 	def load_sharkport(self, f):
 		magic = f.read(17)
 		if magic != PS2SAVE_SPS_MAGIC: